@@ -6,9 +6,9 @@ from migen import *
 
 
 class SPIInterface(Module):
-    """Drive one SPI bus with a single interface or passthrough pins if SPI is offline."""
-    def __init__(self):
-        self.cs = Signal()
+    """Drive one SPI bus with ``cs_width`` chip selects or passthrough pins if SPI is offline."""
+    def __init__(self, cs_width=1):
+        self.cs = Signal(cs_width)
         self.cs_polarity = Signal.like(self.cs)
         self.clk_next = Signal()
         self.clk_polarity = Signal()
@@ -23,15 +23,15 @@ class SPIInterface(Module):
         self.mosi = TSTriple()
         self.miso = TSTriple()
         self.clk = TSTriple()
-        self.cs_spi = TSTriple()
+        self.cs_spi = TSTriple(cs_width)
 
         i = 0
 
-        n = 1
+        n = cs_width
         # TODO cs, clk, mosi to nie powinny być triple, tylko sygnały, do których z zewnątrz się podłączy własciwe
         #  tstriple utworzone w diot_lec_wb
         # cs = TSTriple(n)
-        self.cs_spi.o.reset = C(1)
+        self.cs_spi.o.reset = C(2**n - 1)
         # clk = TSTriple()
         # mosi = TSTriple()
         # miso = TSTriple()
@@ -58,7 +58,7 @@ class SPIInterface(Module):
         ]
         self.sync += [
                 If(self.ce,
-                    self.cs_spi.o.eq((self.cs_next
+                    self.cs_spi.o.eq((Replicate(self.cs_next, n)
                         & self.cs[i:i + n]) ^ ~self.cs_polarity[i:i + n]),
                     self.clk.o.eq(self.clk_next ^ self.clk_polarity)
                 ),
@@ -0,0 +1,176 @@
+"""Cached run of the Yosys, nextpnr and ecppack stages of a LiteX Trellis build.
+
+LiteX writes the Verilog, the constraints and the build script without running them,
+each tool line of the script is then run as a stage. The key of a stage is the SHA-256 of
+the key of the previous stage, its command line, the tool executable and its own input files
+(comment lines left out, they carry the build date). The outputs are stored in the cache
+directory under the key and copied back when the key is seen again, so a stage only runs
+when something it depends on has changed.
+
+Place and route can run several seeds in parallel, the seed with the best worst slack
+over the constrained clocks is used for the bitstream.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "stm_sys_board")
+
+
+def _sources(ys, build_dir):
+    # Verilog files read by the Yosys script
+    sources = []
+    with open(ys) as f:
+        for line in f:
+            words = line.split()
+            if words and words[0] == "read_verilog":
+                filename = os.path.join(build_dir, words[-1])
+                if os.path.isfile(filename):
+                    sources.append(filename)
+    return sources
+
+
+def _hash_file(h, filename):
+    with open(filename, "rb") as f:
+        for line in f:
+            if not line.lstrip().startswith((b"//", b"#")):
+                h.update(line)
+
+
+def _hash_tool(h, tool):
+    path = os.path.realpath(shutil.which(tool) or tool)
+    h.update(path.encode())
+    if os.path.exists(path):
+        stat = os.stat(path)
+        h.update("{} {}".format(stat.st_size, stat.st_mtime_ns).encode())
+
+
+def run_stage(cache_dir, build_dir, command, previous, inputs, outputs):
+    """Run ``command`` in ``build_dir`` unless its ``outputs`` are in the cache.
+
+    Returns the key of the stage and whether it ran.
+    """
+    h = hashlib.sha256()
+    h.update(previous.encode())
+    h.update(command.encode())
+    _hash_tool(h, command.split()[0])
+    for filename in inputs:
+        _hash_file(h, filename)
+    key = h.hexdigest()
+
+    entry = os.path.join(cache_dir, key) if cache_dir is not None else None
+    if entry is not None and os.path.isdir(entry):
+        for filename in outputs:
+            shutil.copy(os.path.join(entry, filename), build_dir)
+        return key, False
+    subprocess.run(command, shell=True, cwd=build_dir, check=True)
+    if entry is not None:
+        # Complete entries only, a stage interrupted or run in parallel leaves no partial entry
+        tmp = "{}.tmp{}".format(entry, os.getpid())
+        os.makedirs(tmp)
+        for filename in outputs:
+            shutil.copy(os.path.join(build_dir, filename), tmp)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp)
+    return key, True
+
+
+def parse_fmax(log):
+    """Achieved and constrained frequency (MHz) per clock from a nextpnr log, after routing."""
+    fmax = {}
+    with open(log) as f:
+        for line in f:
+            m = re.search(r"Max frequency for clock +'(.+)': ([\d.]+) MHz \((PASS|FAIL) at ([\d.]+) MHz\)", line)
+            if m:
+                # Estimates after placement come first, the last report is after routing
+                fmax[m.group(1)] = {"achieved": float(m.group(2)), "constraint": float(m.group(4))}
+    return fmax
+
+
+def worst_slack(fmax):
+    """Worst slack (ns) over the clocks of ``parse_fmax``, None without clocks."""
+    slacks = [1000 / f["constraint"] - 1000 / f["achieved"] for f in fmax.values()]
+    return min(slacks) if slacks else None
+
+
+def _seed_command(command, build_name, seed):
+    command = re.sub(r"--seed +\d+", "", command)
+    command = command.replace("--textcfg {}.config".format(build_name),
+                              "--textcfg {}.seed{}.config".format(build_name, seed))
+    return "{} --seed {} --log {}.seed{}.log".format(command.strip(), seed, build_name, seed)
+
+
+def _place_route(cache_dir, build_dir, build_name, command, previous, seeds, jobs):
+    lpf = os.path.join(build_dir, build_name + ".lpf")
+
+    def run(seed):
+        outputs = ["{}.seed{}.{}".format(build_name, seed, suffix) for suffix in ["config", "log"]]
+        try:
+            key, ran = run_stage(cache_dir, build_dir, _seed_command(command, build_name, seed),
+                              previous, [lpf], outputs)
+        except subprocess.CalledProcessError:
+            return {"seed": seed, "failed": True}
+        fmax = parse_fmax(os.path.join(build_dir, outputs[1]))
+        return {"seed": seed, "key": key, "ran": ran, "fmax": fmax, "worst_slack_ns": worst_slack(fmax)}
+
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        results = list(pool.map(run, seeds))
+    placed = [r for r in results if not r.get("failed")]
+    if not placed:
+        raise RuntimeError("place and route failed for all seeds")
+    best = max(placed, key=lambda r: float("-inf") if r["worst_slack_ns"] is None else r["worst_slack_ns"])
+    for suffix, target in [("config", "config"), ("log", "pnr.log")]:
+        shutil.copy(os.path.join(build_dir, "{}.seed{}.{}".format(build_name, best["seed"], suffix)),
+                    os.path.join(build_dir, "{}.{}".format(build_name, target)))
+    with open(os.path.join(build_dir, build_name + ".seeds.json"), "w") as f:
+        json.dump({"best_seed": best["seed"], "seeds": [{k: v for k, v in r.items() if k != "key"} for r in results]},
+                  f, indent=2)
+    return best["key"], any(r.get("ran") for r in placed)
+
+
+def cached_build(platform, fragment, cache_dir, build_dir="build", build_name="top", seeds=None, jobs=None,
+                 **kwargs):
+    """``platform.build`` with the toolchain stages taken from ``cache_dir`` when unchanged
+    (``cache_dir`` None: always run them).
+
+    ``seeds`` is a list of nextpnr seeds placed and routed in parallel by ``jobs`` processes
+    (default: the seed of the build script). The results per seed are written to <build_name>.seeds.json.
+    Returns the tools that had to run.
+    """
+    platform.build(fragment, build_dir=build_dir, build_name=build_name, run=False, **kwargs)
+    with open(os.path.join(build_dir, "build_" + build_name + ".sh")) as f:
+        commands = [line.strip() for line in f]
+
+    def command(tool):
+        lines = [c for c in commands if c.split()[:1] == [tool]]
+        assert len(lines) == 1, "no {} command in the build script".format(tool)
+        return lines[0]
+
+    ran = []
+    ys = os.path.join(build_dir, build_name + ".ys")
+    key, synthesized = run_stage(cache_dir, build_dir, command("yosys"), "", [ys] + _sources(ys, build_dir),
+                              [build_name + ".json", build_name + ".rpt"])
+    if synthesized:
+        ran.append("yosys")
+
+    pnr = command("nextpnr-ecp5")
+    if seeds is None:
+        m = re.search(r"--seed +(\d+)", pnr)
+        seeds = [int(m.group(1)) if m else 1]
+    key, placed = _place_route(cache_dir, build_dir, build_name, pnr, key, seeds, jobs)
+    if placed:
+        ran.append("nextpnr-ecp5")
+
+    key, packed = run_stage(cache_dir, build_dir, command("ecppack"), key, [],
+                         [build_name + ".bit", build_name + ".svf"])
+    if packed:
+        ran.append("ecppack")
+    return ran
@@ -0,0 +1,193 @@
+"""Timing and resource report of a build, compared against a stored baseline.
+
+Fmax per clock domain, critical paths and device utilization come from the nextpnr log,
+cell counts of the whole design from the Yosys log. migen writes the design as one flat module,
+so the cost of one ``SlotController`` comes from synthesizing a slot with its CSR bank on its own,
+once per distinct feature set.
+"""
+import json
+import os
+import re
+from migen import *
+from migen.fhdl import verilog
+from misoc.interconnect import csr_bus
+from build_cache import run_stage, parse_fmax
+from stm_sys_board_hdl import SlotController, SLOT_FEATURES
+
+
+# Clock domains and the pins clocking them, sck0 is the falling edge of the SPI clock
+CLOCK_PINS = {
+    "sys": "clk100",
+    "sck0": "qspix[14]0_clk",
+    "sck1": "qspix[14]0_clk",
+    "stm": "clk_stm"
+}
+CLOCK_PINS.update({"spi{}".format(i): "spi_slave{}_clk".format(i) for i in range(1, 7)})
+
+
+class SlotControllerTop(Module):
+    """One ``SlotController`` with ``features`` and ``spi_cs`` chip selects, its CSR bank, pins and bus as ports."""
+    def __init__(self, features=SLOT_FEATURES, spi_cs=1):
+        self.clock_domains.cd_sys = ClockDomain("sys")
+        # The event timestamp is shared by all slots on the board, so it is a port here
+        self.timestamp = Signal(43)
+        self.submodules.slot = SlotController(timestamp=self.timestamp, features=features, spi_cs=spi_cs)
+        # One bus word per 16 bits of each CSR
+        csrs = self.slot.get_csrs()
+        registers = sum((c.size + 15) // 16 for c in csrs)
+        address_width = bits_for(registers - 1)
+        # Bank selected by the top address bit, as on the board
+        self.bus = csr_bus.Interface(data_width=16, address_width=address_width + 1)
+        self.submodules.bank = csr_bus.CSRBank(csrs, bus=self.bus, align_bits=11 - address_width)
+        assert len(self.bank.simple_csrs) == registers
+        self.ios = {self.cd_sys.clk, self.cd_sys.rst, self.timestamp, self.slot.io_interrupt, self.slot.interrupt_ack}
+        self.ios |= set(self.bus.flatten())
+        for t in self.slot.slot:
+            self.ios |= {t.o, t.oe, t.i}
+
+
+def parse_cells(log):
+    """Cell counts of the last ``stat`` in a Yosys log."""
+    cells = {}
+    with open(log) as f:
+        for line in f:
+            if "Number of cells:" in line:
+                cells = {}
+                continue
+            m = re.match(r"^\s+(\$?[A-Za-z_][\w$]*)\s+(\d+)$", line)
+            if m:
+                cells[m.group(1)] = int(m.group(2))
+    return cells
+
+
+def parse_utilization(log):
+    """Used and available resources per type from the nextpnr device utilisation."""
+    utilization = {}
+    with open(log) as f:
+        for line in f:
+            m = re.match(r"^Info:\s+(\w+):\s+(\d+)/\s*(\d+)\s+\d+%", line)
+            if m:
+                utilization[m.group(1)] = {"used": int(m.group(2)), "available": int(m.group(3))}
+    return utilization
+
+
+def parse_critical_paths(log):
+    """Delay, source and sink of the critical path per clock (and clock pair) in a nextpnr log."""
+    paths = {}
+    path = None
+    with open(log) as f:
+        for line in f:
+            m = re.search(r"Critical path report for (?:clock|cross-domain path) (.+):$", line.strip())
+            if m:
+                path = {"delay_ns": None, "source": None, "sink": None}
+                paths[m.group(1)] = path
+                continue
+            if path is None:
+                continue
+            m = re.match(r"^Info:\s+[\d.]+\s+([\d.]+)\s+(\w+)\s+(\S+)", line)
+            if m:
+                path["delay_ns"] = float(m.group(1))
+                if m.group(2) == "Source" and path["source"] is None:
+                    path["source"] = m.group(3)
+            m = re.match(r"^Info:\s+Sink\s+(\S+)", line)
+            if m:
+                path["sink"] = m.group(1)
+            if re.search(r"ns logic, [\d.]+ ns routing", line):
+                path = None
+    return paths
+
+
+def clock_domains(fmax):
+    """Fmax and slack per clock domain of ``CLOCK_PINS``, from ``parse_fmax``."""
+    domains = {}
+    for domain, pin in CLOCK_PINS.items():
+        for clock, f in fmax.items():
+            # Nets of the same pin (e.g. before and after the global buffer): keep the slowest
+            if re.search(r"(^|\W){}(\W|$)".format(pin), clock) and \
+                    (domain not in domains or f["achieved"] < domains[domain]["achieved"]):
+                domains[domain] = dict(f, clock=clock, slack_ns=1000 / f["constraint"] - 1000 / f["achieved"])
+    return domains
+
+
+def feature_name(features):
+    """Feature set as a name, in ``SLOT_FEATURES`` order (gpio: none)."""
+    return ",".join(f for f in SLOT_FEATURES if f in features) or "gpio"
+
+
+def slot_cells(build_dir, cache_dir, features=SLOT_FEATURES, spi_cs=1):
+    """Cells of one ``SlotController`` synthesized on its own."""
+    top = SlotControllerTop(features, spi_cs)
+    name = "slot_controller_" + feature_name(features).replace(",", "_")
+    verilog.convert(top, top.ios, name="slot_controller").write(os.path.join(build_dir, name + ".v"))
+    run_stage(cache_dir, build_dir,
+           "yosys -l {0}.rpt -p \"read_verilog {0}.v; synth_ecp5 -top slot_controller\"".format(name),
+           "", [os.path.join(build_dir, name + ".v")], [name + ".rpt"])
+    return parse_cells(os.path.join(build_dir, name + ".rpt"))
+
+
+def build_report(build_dir, build_name, cache_dir=None, slots=8, spi_cs=1):
+    # slots: slot index -> features, or a number of slots with all features (as STMSysBoard.add_core),
+    # the slot controller cells are reported once per distinct feature set
+    if isinstance(slots, int):
+        slots = {i: SLOT_FEATURES for i in range(slots)}
+    names = {}
+    for i, features in sorted(slots.items()):
+        names.setdefault(feature_name(features), []).append(i)
+    pnr_log = os.path.join(build_dir, build_name + ".pnr.log")
+    report = {
+        "domains": clock_domains(parse_fmax(pnr_log)),
+        "critical_paths": parse_critical_paths(pnr_log),
+        "utilization": parse_utilization(pnr_log),
+        "cells": parse_cells(os.path.join(build_dir, build_name + ".rpt")),
+        "slot_controllers": {name: {"slots": indices, "spi_cs": spi_cs,
+                                    "cells": slot_cells(build_dir, cache_dir, slots[indices[0]], spi_cs)}
+                             for name, indices in names.items()}
+    }
+    seeds = os.path.join(build_dir, build_name + ".seeds.json")
+    if os.path.exists(seeds):
+        with open(seeds) as f:
+            report["seed"] = json.load(f)["best_seed"]
+    return report
+
+
+def compare(report, baseline):
+    """Changes from ``baseline`` to ``report``: Fmax per domain (MHz), used resources and cells of one slot
+    per feature set in both."""
+    changes = {"fmax_mhz": {}, "utilization": {}, "slot_controller_cells": {}}
+    for domain, d in report["domains"].items():
+        if domain in baseline["domains"]:
+            changes["fmax_mhz"][domain] = round(d["achieved"] - baseline["domains"][domain]["achieved"], 2)
+    for name, u in report["utilization"].items():
+        if name in baseline["utilization"]:
+            changes["utilization"][name] = u["used"] - baseline["utilization"][name]["used"]
+    for features, slot in report["slot_controllers"].items():
+        if features in baseline.get("slot_controllers", {}):
+            cells = slot["cells"]
+            base_cells = baseline["slot_controllers"][features]["cells"]
+            changes["slot_controller_cells"][features] = {name: cells.get(name, 0) - base_cells.get(name, 0)
+                                                          for name in sorted(set(cells) | set(base_cells))}
+    return changes
+
+
+def write_report(report, filename, baseline=None):
+    """Write ``report`` as JSON, with the changes from the baseline file ``baseline`` if it exists."""
+    if baseline is not None and os.path.exists(baseline):
+        with open(baseline) as f:
+            report = dict(report, changes=compare(report, json.load(f)))
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def print_report(report):
+    changes = report.get("changes", {})
+    for domain, d in sorted(report["domains"].items()):
+        change = changes.get("fmax_mhz", {}).get(domain)
+        print("{:5} {:8.2f} MHz (target {:6.2f}, slack {:6.2f} ns){}".format(
+            domain, d["achieved"], d["constraint"], d["slack_ns"],
+            "" if change is None else ", {:+.2f} MHz from baseline".format(change)))
+    for name, u in sorted(report["utilization"].items()):
+        change = changes.get("utilization", {}).get(name)
+        if u["used"] or change:
+            print("{:16} {:6}/{:6}{}".format(name, u["used"], u["available"],
+                                              ", {:+} from baseline".format(change) if change else ""))
@@ -6,6 +6,8 @@ module counter
 	en
 );
     parameter WIDTH = 8;
+    // Stop at all ones instead of wrapping around
+    parameter SATURATE = 0;
 	input clk;
 	input reset;
 	input en;
@@ -15,7 +17,7 @@ module counter
 	begin
 	    if (reset) begin
 			counter = 0;
-		end	else if (en) begin
+		end	else if (en && !(SATURATE && &counter)) begin
 			counter = counter + 1;
 		end
 	end
@@ -0,0 +1,60 @@
+import json
+import os
+from misoc.interconnect.csr import CSR, CSRStatus, CSRStorage
+from csr_read import ReadCSR, ReadCSRStatus
+
+
+def get_csr_map(bank, csrs, address_width, page_width=0):
+    """Register map of the CSRBank ``bank`` built from ``csrs``.
+
+    Addresses are bus word addresses, registers wider than a bus word
+    take consecutive addresses with the most significant word first.
+    """
+    addresses = {id(sc): i for i, sc in enumerate(bank.simple_csrs)}
+    registers = []
+    for c in csrs:
+        simple_csrs = [c] if isinstance(c, CSR) else c.get_simple_csrs()
+        if isinstance(c, CSRStorage):
+            access = "rw"
+        elif isinstance(c, CSRStatus):
+            access = "r"
+        else:
+            access = "csr"
+        registers.append({
+            "name": c.name,
+            "address": addresses[id(simple_csrs[0])],
+            "size": c.size,
+            "words": len(simple_csrs),
+            "access": access,
+            "read_side_effect": isinstance(c, (ReadCSR, ReadCSRStatus))
+        })
+    return {
+        "data_width": len(bank.bus.dat_w),
+        "address_width": address_width,
+        "page_width": page_width,
+        "registers": registers
+    }
+
+
+def write_csr_map(csr_map, directory):
+    """Write ``csr_map`` as csr_map.json, C header csr.h and Verilog header csr_map.vh."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "csr_map.json"), "w") as f:
+        json.dump(csr_map, f, indent=2)
+
+    with open(os.path.join(directory, "csr.h"), "w") as f:
+        f.write("/* Generated by stm_sys_board_hdl.py, do not edit */\n")
+        f.write("#ifndef __STM_SYS_BOARD_CSR_H\n#define __STM_SYS_BOARD_CSR_H\n\n")
+        f.write("#define CSR_ADDRESS_WIDTH {}\n".format(csr_map["address_width"]))
+        f.write("#define CSR_PAGE_WIDTH {}\n\n".format(csr_map["page_width"]))
+        for r in csr_map["registers"]:
+            name = r["name"].upper()
+            f.write("#define CSR_{}_ADDR 0x{:03x}\n".format(name, r["address"]))
+            f.write("#define CSR_{}_SIZE {}\n".format(name, r["size"]))
+        f.write("\n#endif\n")
+
+    with open(os.path.join(directory, "csr_map.vh"), "w") as f:
+        f.write("// Generated by stm_sys_board_hdl.py, do not edit\n")
+        for r in csr_map["registers"]:
+            f.write("`define CSR_{} {}'h{:03x}\n".format(r["name"].upper(),
+                                                      csr_map["address_width"] + csr_map["page_width"], r["address"]))
@@ -0,0 +1,58 @@
+from migen import *
+from misoc.interconnect.csr import CSR, CSRStatus
+
+
+class _ReadStrobes:
+    def _add_strobes(self, size):
+        self.read = Signal()
+        self.read_data = Signal(size)
+        self.fetch = Signal()
+        self.pops = []
+
+    def popped(self, readable):
+        """Pulse with ``read`` when the value was fetched while ``readable`` was set, so that a FIFO
+        behind the register pops only words the host received, not a 0 returned while empty."""
+        pop = Signal()
+        self.pops.append((readable, pop))
+        return pop
+
+
+class ReadCSR(CSR, _ReadStrobes):
+    """CSR with a ``read`` pulse once its value has been handed over to the host, with the value in ``read_data``.
+    ``fetch`` pulses when the host link reads the value from the bus, before it is handed over (or dropped)."""
+    def __init__(self, size=1, name=None):
+        CSR.__init__(self, size, name=name)
+        self._add_strobes(size)
+
+
+class ReadCSRStatus(CSRStatus, _ReadStrobes):
+    """CSRStatus with the ``read``, ``read_data`` and ``fetch`` signals of ``ReadCSR``."""
+    def __init__(self, size=1, reset=0, name=None):
+        CSRStatus.__init__(self, size, reset, name=name)
+        self._add_strobes(size)
+
+
+class CSRReadStrobes(Module):
+    """Drive ``read`` of the ReadCSR/ReadCSRStatus registers in ``csrs`` from the bridge read strobe,
+    and their ``popped`` pulses.
+
+    ``csrs`` is the list the CSRBank ``bank`` was built from, ``read_adr`` and ``read_data``
+    the bus address and value of the word read, ``fetch_strobe`` and ``fetch_adr`` the bus read
+    of the bridge for ``fetch``. Registers with read side effects must fit in one bus word.
+    """
+    def __init__(self, bank, csrs, read_strobe, read_adr, read_data, fetch_strobe=0, fetch_adr=0):
+        for c in csrs:
+            if not isinstance(c, (ReadCSR, ReadCSRStatus)):
+                continue
+            simple_csrs = [c] if isinstance(c, CSR) else c.get_simple_csrs()
+            assert len(simple_csrs) == 1
+            adr = [i for i, sc in enumerate(bank.simple_csrs) if sc is simple_csrs[0]][0]
+            self.comb += [
+                c.read.eq(read_strobe & (read_adr == adr)),
+                c.fetch.eq(fetch_strobe & (fetch_adr == adr)),
+                c.read_data.eq(read_data)
+            ]
+            for readable, pop in c.pops:
+                fetched = Signal()
+                self.sync += If(c.fetch, fetched.eq(readable))
+                self.comb += pop.eq(c.read & fetched)
@@ -48,7 +48,8 @@
       stm_sys_board-hdl = pkgs.stdenv.mkDerivation {
         name = "stm_sys_board-hdl";
         phases = [ "buildPhase" "installPhase" ];
-        src = self;
+        # Only the gateware sources, changes to docs or programming scripts don't rebuild
+        src = pkgs.lib.sourceFilesBySuffices self [ ".py" ".v" ];
         buildInputs = [
          (pkgs.python3.withPackages(f: [ migen misoc litex ]))
           pkgs.yosys
@@ -56,13 +57,14 @@
           pkgs.trellis
         ];
         buildPhase = ''
-        python $src/stm_sys_board_hdl.py
+        python $src/stm_sys_board_hdl.py --no-cache
         '';
 
         installPhase = ''
         mkdir -p $out
         mv ./build/stm_sys_board.bit $out/stm_sys_board.bit
         mv ./build/stm_sys_board.svf $out/stm_sys_board.svf
+        mv ./build/csr_map.json ./build/csr.h ./build/csr_map.vh $out/
         '';
 
       };
@@ -117,6 +119,14 @@
         ];
       };
       
+      # Register accesses and slot controller features in simulation, run by nix flake check
+      checks.x86_64-linux.simulation = pkgs.runCommand "stm_sys_board-sim" {
+        src = pkgs.lib.sourceFilesBySuffices self [ ".py" ];
+        buildInputs = [ (pkgs.python3.withPackages(f: [ migen misoc litex ])) ];
+      } ''
+        PYTHONDONTWRITEBYTECODE=1 python $src/stm_sys_board_sim.py --check > $out
+      '';
+
       defaultPackage.x86_64-linux = stm_sys_board-hdl;
     };
       
@@ -1,32 +1,81 @@
 import os
+from functools import reduce
+from operator import xor
 from migen import *
 from migen.genlib.cdc import PulseSynchronizer, MultiReg
-from math import log2, ceil
+from math import ceil
+
+
+# CRC-8 of the burst frame: MSB first, no final XOR
+CRC_POLY = 0x07
+CRC_INIT = 0xff
+
+
+def crc8(data, crc=CRC_INIT):
+    """CRC register (8 bits) after shifting ``data`` MSB first into ``crc``, as an expression."""
+    if isinstance(crc, int):
+        crc = Constant(crc, 8)
+    # Terms of every CRC bit: ("crc", i) and ("data", j)
+    bits = [{("crc", i)} for i in range(8)]
+    for j in reversed(range(len(data))):
+        feedback = bits[7] ^ {("data", j)}
+        bits = [(bits[i - 1] if i else set()) ^ (feedback if CRC_POLY >> i & 1 else set()) for i in range(8)]
+    return Cat(*[reduce(xor, [crc[i] if kind == "crc" else data[i] for kind, i in sorted(terms)], 0)
+                 for terms in bits])
 
 
 class SPI2WB(Module):
-    def __init__(self, platform, wb_bus, address_width=7, data_width=16):
+    """SPI slave to Wishbone master bridge, frame timing, lanes, CRC and shadow reads are described in Readme.md.
+
+    Frame:
+        r/~w bit, fixed address bit, shadow read bit, zero padding, address, [CRC-8], dummy cycles (read only),
+        data words [each followed by its CRC-8]...
+
+    With ``lanes`` 2 or 4 ``sdi``/``sdo`` are the same pins, driven by the bridge while ``sdo_oe`` is high.
+    ``read_strobe`` pulses with ``read_adr`` and ``read_data`` once a read word is handed over to the host,
+    ``fetch_strobe`` when a read of the link returns on Wishbone (address on the bus). ``crc_error``,
+    ``frame_strobe``, ``write_strobe``, ``bus_wait`` and ``late_read`` feed the error and performance counters.
+    All of them are in the sys domain. With ``platform`` None the SCK counter is built without counter.v,
+    for simulation.
+    """
+    def __init__(self, platform, wb_bus, address_width=7, data_width=16, read_dummy=11, lanes=1,
+                 shadow=False, shadow_dummy=2, shadow_depth=None, crc=False):
         self.wb = wb_bus
-        # 1 bit r/~w, 7 bit address, 16 bit data
-        # Width is 1 bit larger that address+data
-        self.width = 1 + address_width + data_width
+        self.read_strobe = Signal()
+        self.read_adr = Signal(address_width)
+        self.read_data = Signal(data_width)
+        self.crc_error = Signal()
+        self.fetch_strobe = Signal()
+        self.frame_strobe = Signal()
+        self.write_strobe = Signal()
+        self.bus_wait = Signal()
+        self.late_read = Signal()
 
-        self.sdi = Signal()
-        self.sdo = Signal()
+        self.sdi = Signal(lanes)
+        self.sdo = Signal(lanes)
+        self.sdo_oe = Signal()
         self.sel = Signal()
 
-        self.di = Signal(self.width)
-        sr = Signal(self.width)
-        sr_out = Signal(self.width)
-
-        self.clock_domains.cd_le = ClockDomain("le", reset_less=True)
-        self.specials += Instance("FD1P3BX",
-                                  i_D=0, i_CK=ClockSignal("sck1"), i_SP=self.sel, i_PD=~self.sel,
-                                  o_Q=self.cd_le.clk)
+        if shadow_depth is None:
+            shadow_depth = 2 ** address_width
+        assert address_width <= 13 and shadow_depth <= 2 ** address_width
+        self._burst_frame(platform, address_width, data_width, read_dummy, lanes, shadow, shadow_dummy,
+                          shadow_depth, crc)
 
-        self.counter1 = Signal(ceil(log2(self.width)))
+    def _add_counter(self, platform, width, saturate=False):
+        self.counter1 = Signal(width)
+        if platform is None:
+            # Simulation model of counter.v, reset while sel is low
+            count = self.counter1 != 2 ** width - 1 if saturate else 1
+            self.sync.sck1 += If(~self.sel,
+                self.counter1.eq(0)
+            ).Elif(count,
+                self.counter1.eq(self.counter1 + 1)
+            )
+            return
         self.specials += Instance("counter",
                                   p_WIDTH=len(self.counter1),
+                                  p_SATURATE=int(saturate),
                                   i_clk=ClockSignal("sck1"),
                                   i_reset=~self.sel | ResetSignal(),
                                   o_counter=self.counter1,
@@ -34,98 +83,305 @@ class SPI2WB(Module):
                                   )
         platform.add_source(os.path.join(os.path.abspath(os.path.dirname(__file__)), "counter.v"))
 
+    def _burst_frame(self, platform, address_width, data_width, read_dummy, lanes, shadow, shadow_dummy,
+                     shadow_depth, crc):
+        assert read_dummy > 0 and shadow_dummy > 0
+        assert lanes in (1, 2, 4)
+        # 1 bit r/~w, 1 bit fixed address, 1 bit shadow read, address, padded to whole bytes, CRC
+        crc_width = 8 if crc else 0
+        header_width = 8 * ceil((3 + address_width) / 8) + crc_width
+        word_width = data_width + crc_width
+        self.width = header_width + word_width
+        # Counter and dummy cycles are in SCK clocks, each clock moves one bit per lane
+        header_clocks = header_width // lanes
+        word_clocks = word_width // lanes
+        # Clocks between read words fetched over Wishbone, to cover the read latency
+        read_clocks = max(word_clocks, read_dummy)
+
+        sr = Signal(max(header_width, word_width))
+        sr_out = Signal(word_width)
+        header_adr = sr[crc_width:crc_width + address_width]
+        # Counter stops once the first read word is loaded, word boundaries are tracked by clk_cnt
+        self._add_counter(platform, bits_for(header_clocks + max(read_dummy, shadow_dummy) + 1), saturate=True)
+        clk_cnt = Signal(max=read_clocks)
+        word_end = Signal()
+
+        adr_sck = Signal(address_width)
         read_sck = Signal()
-        self.debug = Signal()
-        read_wb = Signal()
-        read_addr = Signal(address_width)
-        read_data_sck = Signal(data_width)
+        fixed_sck = Signal()
+        shadow_sck = Signal()
+        # Write words alternate between two registers, so each one is kept for two words
+        # (only 4 clocks per word in quad mode)
+        write_data_sck = Array(Signal(data_width) for _ in range(2))
+        write_ok_sck = Array(Signal() for _ in range(2))
+        write_idx_sck = Signal()
+        read_data_sck = Signal(word_width)
+        # Header CRC check result, always ok without CRC
+        header_ok = Signal(reset=1) if crc else 1
+
+        # Pulses are combinatorial to save one SCK cycle of read latency
+        start_sck = Signal()
+        first_load = Signal(len(self.counter1))
+        read_load = Signal()
+        write_done = Signal()
+        next_sck = Signal()
+        self.comb += [
+            start_sck.eq(self.sel & (self.counter1 == header_clocks)),
+            first_load.eq(Mux(shadow_sck, header_clocks + shadow_dummy, header_clocks + read_dummy)),
+            read_load.eq(self.sel & read_sck & (
+                (self.counter1 == first_load) |
+                ((self.counter1 > first_load) & (clk_cnt == 0)))),
+            word_end.eq(clk_cnt == Mux(read_sck & ~shadow_sck, read_clocks - 1, word_clocks - 1)),
+            write_done.eq(self.sel & ~read_sck & (self.counter1 > header_clocks) & word_end),
+            # Shadow reads never reach Wishbone
+            next_sck.eq(((read_load & ~shadow_sck) | write_done) & header_ok),
+            # Drive the bus from the first read word until CS is released
+            self.sdo_oe.eq(self.sel & read_sck & (self.counter1 > first_load))
+        ]
+
+        start_wb = Signal()
+        next_wb = Signal()
         read_data_wb = Signal(data_width)
-        read_data_valid_sck = Signal()
-        read_data_valid_wb = Signal()
-        read_data_valid_ack_sck = Signal()
-        read_data_valid_ack_wb = Signal()
-        read_data_done = Signal()
-        spi_trans_done = Signal()
+        read_crc_wb = Signal(8)
 
         ps = PulseSynchronizer(idomain="sck1", odomain="sys")
         self.submodules += ps
-        self.comb += [ps.i.eq(read_sck), read_wb.eq(ps.o)]
+        self.comb += [ps.i.eq(start_sck & header_ok), start_wb.eq(ps.o)]
+        ps = PulseSynchronizer(idomain="sck1", odomain="sys")
+        self.submodules += ps
+        self.comb += [ps.i.eq(next_sck), next_wb.eq(ps.o)]
+        self.specials += MultiReg(Cat(read_crc_wb, read_data_wb) if crc else read_data_wb, read_data_sck,
+                                  odomain="sck1")
+
+        if crc:
+            # CRC of the header and the write words, shifted in as they arrive,
+            # the register of a message followed by its CRC is 0
+            crc_sck = Signal(8, reset=CRC_INIT)
+            crc_next = Signal(8)
+            header_end = Signal()
+            crc_error_sck = Signal()
+            self.comb += [
+                crc_next.eq(crc8(self.sdi, Mux(self.counter1 == 0, CRC_INIT, crc_sck))),
+                header_end.eq(self.sel & (self.counter1 == header_clocks - 1)),
+                crc_error_sck.eq((header_end | write_done & header_ok) & (crc_next != 0))
+            ]
+            self.sync.sck1 += If(self.sel,
+                If(header_end | write_done,
+                   crc_sck.eq(CRC_INIT)
+                ).Else(
+                   crc_sck.eq(crc_next)
+                ),
+                If(header_end,
+                   header_ok.eq(crc_next == 0)
+                ),
+                If(write_done,
+                   write_ok_sck[write_idx_sck].eq(crc_next == 0)
+                )
+            )
+            ps = PulseSynchronizer(idomain="sck1", odomain="sys")
+            self.submodules += ps
+            self.comb += [ps.i.eq(crc_error_sck), self.crc_error.eq(ps.o)]
+
+        load_data = Signal(word_width)
+        if shadow:
+            # Copy of the whole address space, refreshed from Wishbone while the link is idle
+            # and read directly in the SCK domain
+            mem = Memory(word_width, shadow_depth)
+            shadow_r = mem.get_port(clock_domain="sck1")
+            shadow_w = mem.get_port(write_capable=True)
+            self.specials += mem, shadow_r, shadow_w
+            shadow_adr = Signal(address_width)
+            self.comb += [
+                shadow_r.adr.eq(Mux(start_sck, header_adr, shadow_adr)),
+                load_data.eq(Mux(shadow_sck, shadow_r.dat_r, read_data_sck))
+            ]
+            self.sync.sck1 += [
+                If(start_sck,
+                   shadow_sck.eq(sr[header_width - 3]),
+                   shadow_adr.eq(header_adr)
+                ).Elif(read_load & ~fixed_sck,
+                   shadow_adr.eq(shadow_adr + 1)
+                )
+            ]
+        else:
+            self.comb += load_data.eq(read_data_sck)
+        # Every Wishbone read of the link toggles read_seq_wb, a word loaded before the toggle
+        # of its read is late. The first read is requested after start_sck, then one per load.
+        read_seq_wb = Signal()
+        read_seq_sck = Signal()
+        expected_seq = Signal()
+        late_sck = Signal()
+        self.specials += MultiReg(read_seq_wb, read_seq_sck, odomain="sck1")
+        self.comb += late_sck.eq(read_load & ~shadow_sck & header_ok & (read_seq_sck != expected_seq))
+        self.sync.sck1 += If(start_sck,
+                expected_seq.eq(~read_seq_sck)
+            ).Elif(read_load,
+                expected_seq.eq(~expected_seq)
+            )
         ps = PulseSynchronizer(idomain="sck1", odomain="sys")
         self.submodules += ps
-        self.comb += [ps.i.eq(read_data_valid_ack_sck), read_data_valid_ack_wb.eq(ps.o)]
-        self.specials += MultiReg(read_data_wb, read_data_sck, odomain="sck1")
-        self.specials += MultiReg(read_data_valid_wb, read_data_valid_sck, odomain="sck1")
+        self.comb += [ps.i.eq(late_sck), self.late_read.eq(ps.o)]
+
+        # Read words of a rejected header go out with an inverted CRC
+        load_word = Signal(word_width)
+        self.comb += load_word.eq(load_data ^ Replicate(~header_ok, crc_width) if crc else load_data)
 
         self.sync.sck1 += [
-            read_sck.eq(0),
-            read_data_valid_ack_sck.eq(0),
-            self.debug.eq(0),
             If(self.sel,
-               If(self.counter1 == 0,
-                  read_data_done.eq(0),
+               sr.eq(Cat(self.sdi, sr)),
+               If(word_end,
+                  clk_cnt.eq(0)
+               ).Else(
+                  clk_cnt.eq(clk_cnt + 1)
                ),
-               If(self.counter1 == address_width + 1,
-                  If(sr[address_width],
-                     read_sck.eq(1),
-                  ),
-                  self.debug.eq(1),
-                  read_addr.eq(sr[0:address_width])
+               If(start_sck,
+                  # Header is complete, this edge samples the first data bit
+                  read_sck.eq(sr[header_width - 1]),
+                  fixed_sck.eq(sr[header_width - 2]),
+                  adr_sck.eq(header_adr),
+                  write_idx_sck.eq(0),
+                  clk_cnt.eq(1)
                ),
-               If(read_data_valid_sck & ~read_data_done,
-                  read_data_valid_ack_sck.eq(1),
-                  read_data_done.eq(1),
-                  self.sdo.eq(read_data_sck[-1]),
-                  sr_out[address_width + 2:].eq(read_data_sck[:-1])
+               If(read_load,
+                  # Word read in advance is shifted out, request the next one
+                  clk_cnt.eq(1),
+                  self.sdo.eq(load_word[-lanes:]),
+                  sr_out.eq(load_word << lanes)
                ).Else(
-                  self.sdo.eq(sr_out[-1]),
-                  sr[0].eq(self.sdi),
-                  sr_out[0].eq(0),
-                  sr[1:].eq(sr[:-1]),
-                  sr_out[1:].eq(sr_out[:-1])
+                  self.sdo.eq(sr_out[-lanes:]),
+                  sr_out.eq(sr_out << lanes)
+               ),
+               If(write_done,
+                  write_data_sck[write_idx_sck].eq(Cat(self.sdi, sr[:word_width - lanes])[crc_width:]),
+                  write_idx_sck.eq(~write_idx_sck)
                )
             )
         ]
 
-        self.sync.le += [
-            self.di.eq(sr),
+        adr = Signal(address_width)
+        next_adr = Signal(address_width)
+        read = Signal()
+        fixed = Signal()
+        write_idx = Signal()
+        self.comb += [
+            next_adr.eq(Mux(fixed, adr, adr + 1)),
+            self.read_strobe.eq(next_wb & read),
+            self.frame_strobe.eq(start_wb),
+            self.read_adr.eq(adr),
+            self.read_data.eq(read_data_wb)
         ]
-        wb_trans_done = Signal()
-        spi_trans_done_blocker = Signal()
         self.sync.sys += [
-            If(self.sel,
-               wb_trans_done.eq(0),
-               spi_trans_done_blocker.eq(0)
+            If(start_wb,
+               adr.eq(adr_sck),
+               read.eq(read_sck),
+               fixed.eq(fixed_sck),
+               write_idx.eq(0)
             ),
-            If(~read_data_done & ~self.sel & ~spi_trans_done_blocker,
-               spi_trans_done.eq(1)
-            ),
-            If(read_data_valid_ack_wb,
-               read_data_valid_wb.eq(0),
+            If(next_wb,
+               adr.eq(next_adr),
+               write_idx.eq(~write_idx)
+            )
+        ]
+
+        # Wishbone request from the SPI side
+        req = Signal()
+        req_adr = Signal(address_width)
+        req_we = Signal()
+        req_dat = Signal(data_width)
+        self.comb += [
+            If(start_wb & read_sck & ~shadow_sck,
+               # Fetch the first read word during the dummy cycles
+               req.eq(1),
+               req_adr.eq(adr_sck)
             ),
+            If(next_wb,
+               If(read,
+                  # Previous word was handed over, fetch the following one
+                  req.eq(1),
+                  req_adr.eq(next_adr)
+               ).Elif(write_ok_sck[write_idx] if crc else 1,
+                  req.eq(1),
+                  req_adr.eq(adr),
+                  req_we.eq(1),
+                  req_dat.eq(write_data_sck[write_idx])
+               )
+            )
+        ]
+
+        # Requests are issued right away, or after the shadow refresh cycle in progress
+        pending = Signal()
+        pending_adr = Signal(address_width)
+        pending_we = Signal()
+        pending_dat = Signal(data_width)
+        scan = Signal()
+        bus_free = Signal()
+        self.comb += [
+            bus_free.eq(~self.wb.cyc | self.wb.ack),
+            self.wb.sel.eq(2 ** len(self.wb.sel) - 1),
+            self.write_strobe.eq(req & req_we),
+            self.fetch_strobe.eq(self.wb.ack & ~self.wb.we & ~scan),
+            self.bus_wait.eq(pending | self.wb.cyc & ~self.wb.ack & ~scan)
+        ]
+        self.sync.sys += [
             If(self.wb.ack,
                self.wb.cyc.eq(0),
                self.wb.stb.eq(0),
                self.wb.we.eq(0),
-               spi_trans_done.eq(0),
-               spi_trans_done_blocker.eq(1),
-               If(~self.wb.we,
+               If(~self.wb.we & ~scan,
                   read_data_wb.eq(self.wb.dat_r),
-                  read_data_valid_wb.eq(1)
+                  read_seq_wb.eq(~read_seq_wb)
                )
-            ).Elif(read_wb,
-               self.wb.adr.eq(read_addr),
-               self.wb.we.eq(0),
-               self.wb.stb.eq(1),
-               self.wb.cyc.eq(1),
-            ).Elif(spi_trans_done & ~read_data_done & ~wb_trans_done,
-               self.wb.adr.eq(read_addr),
-               self.wb.dat_w.eq(self.di[:data_width]),
-               self.wb.sel.eq(2 ** len(self.wb.sel) - 1),
-               self.wb.we.eq(1),
-               self.wb.cyc.eq(1),
-               self.wb.stb.eq(1),
-               spi_trans_done.eq(0),
-               spi_trans_done_blocker.eq(1),
-               wb_trans_done.eq(1)
+            ),
+            If(bus_free,
+               If(pending,
+                  self.wb.adr.eq(pending_adr),
+                  self.wb.we.eq(pending_we),
+                  self.wb.dat_w.eq(pending_dat),
+                  self.wb.cyc.eq(1),
+                  self.wb.stb.eq(1),
+                  scan.eq(0),
+                  pending.eq(0)
+               ).Elif(req,
+                  self.wb.adr.eq(req_adr),
+                  self.wb.we.eq(req_we),
+                  self.wb.dat_w.eq(req_dat),
+                  self.wb.cyc.eq(1),
+                  self.wb.stb.eq(1),
+                  scan.eq(0)
+               )
+            ),
+            If(req & (~bus_free | pending),
+               pending.eq(1),
+               pending_adr.eq(req_adr),
+               pending_we.eq(req_we),
+               pending_dat.eq(req_dat)
             )
         ]
+        if crc:
+            self.sync.sys += If(self.wb.ack & ~self.wb.we & ~scan,
+                read_crc_wb.eq(crc8(self.wb.dat_r))
+            )
+
+        if shadow:
+            sel_sys = Signal()
+            scan_adr = Signal(address_width)
+            scan_next = Signal(address_width)
+            self.specials += MultiReg(self.sel, sel_sys)
+            self.comb += [
+                scan_next.eq(Mux(scan_adr == shadow_depth - 1, 0, scan_adr + 1)),
+                shadow_w.adr.eq(scan_adr),
+                shadow_w.dat_w.eq(Cat(crc8(self.wb.dat_r), self.wb.dat_r) if crc else self.wb.dat_r),
+                shadow_w.we.eq(self.wb.ack & scan)
+            ]
+            self.sync.sys += [
+                If(self.wb.ack & scan,
+                   scan_adr.eq(scan_next)
+                ),
+                If(bus_free & ~pending & ~req & ~sel_sys,
+                   self.wb.adr.eq(Mux(self.wb.ack & scan, scan_next, scan_adr)),
+                   self.wb.we.eq(0),
+                   self.wb.cyc.eq(1),
+                   self.wb.stb.eq(1),
+                   scan.eq(1)
+                )
+            ]
@@ -0,0 +1,141 @@
+"""Benchmark of the SPI link in simulation across SCK periods.
+
+For every SCK period (and a few SCK/sys clock phases) it finds the minimum read dummy count giving
+correct reads, the time from CS release after a write until the register changes, and the sustained
+rate of back to back single writes, single reads and burst reads. The report is written as JSON.
+"""
+import json
+from migen import *
+from stm_sys_board_sim import STMSysBoardSim, SPIHost, run
+from stm_sys_board_driver import STMSysBoardDriver
+
+
+PATTERNS = [0xa5a5, 0x5a5a]
+
+
+def reads_ok(sck_period, read_dummy, spi_lanes=1, sck_phase=0):
+    """True if single and burst reads return the written values with ``read_dummy`` cycles."""
+    dut = STMSysBoardSim(spi_lanes=spi_lanes, slots=1, read_dummy=read_dummy)
+    host = SPIHost(dut.spi_slave, lanes=spi_lanes, read_dummy=read_dummy)
+    driver = STMSysBoardDriver(None, dut.csr_map)
+    names = ["logic0_output", "logic0_oe", "logic0_interrupt_mask"]
+    results = []
+
+    def program():
+        for pattern in PATTERNS:
+            for i, name in enumerate(names):
+                driver.write(name, pattern ^ i)
+            yield from host.run_driver(driver)
+            results.append([(driver.read(name), pattern ^ i) for i, name in enumerate(names)])
+            yield from host.run_driver(driver)
+            results.append([(driver.read(names[0]), pattern)])
+            yield from host.run_driver(driver)
+
+    run(dut, program(), sck_period, sck_phase=sck_phase)
+    return all(r.value == expected for frame in results for r, expected in frame)
+
+
+def min_read_dummy(sck_period, spi_lanes=1, phases=(0, 5), max_dummy=16):
+    """Smallest dummy count that reads correctly at all ``phases`` (ns) of SCK against sys, None if none does."""
+    def ok(dummy):
+        return all(reads_ok(sck_period, dummy, spi_lanes, phase) for phase in phases)
+    if not ok(max_dummy):
+        return None
+    low, high = 0, max_dummy
+    while high - low > 1:
+        mid = (low + high) // 2
+        if ok(mid):
+            high = mid
+        else:
+            low = mid
+    return high
+
+
+def write_latency(sck_period, spi_lanes=1, sys_period=10, writes=4):
+    """Time (ns) from CS release after a single write until the register has the written value, worst of ``writes``."""
+    dut = STMSysBoardSim(spi_lanes=spi_lanes, slots=1)
+    host = SPIHost(dut.spi_slave, lanes=spi_lanes)
+    driver = STMSysBoardDriver(None, dut.csr_map)
+    storage = dut.logic0.output.storage
+    state = {"expected": None, "done": False}
+    latencies = []
+
+    def program():
+        for i in range(writes):
+            driver.write("logic0_output", PATTERNS[i % len(PATTERNS)])
+            frame = driver.take_frames()[0]
+            yield from host.frame(frame.header, frame.words)
+            state["expected"] = frame.words[0]
+            while state["expected"] is not None:
+                yield
+        state["done"] = True
+
+    def monitor():
+        cycles = 0
+        while not state["done"]:
+            if state["expected"] is not None:
+                cycles += 1
+                if (yield storage) == state["expected"]:
+                    latencies.append(cycles * sys_period)
+                    state["expected"] = None
+                    cycles = 0
+            yield
+
+    run(dut, program(), sck_period, sys_period=sys_period, sys=[monitor()])
+    return max(latencies)
+
+
+def throughput(sck_period, spi_lanes=1, frames=8, burst=8):
+    """Transactions and words per second of back to back frames."""
+    dut = STMSysBoardSim(spi_lanes=spi_lanes, slots=1)
+    host = SPIHost(dut.spi_slave, lanes=spi_lanes)
+    driver = STMSysBoardDriver(None, dut.csr_map)
+
+    def program():
+        for i in range(frames):
+            driver.write("logic0_output", i)
+            yield from host.run_driver(driver)
+        for i in range(frames):
+            driver.read("logic0_output")
+            yield from host.run_driver(driver)
+        for i in range(frames):
+            for j in range(burst):
+                driver.read("id")
+            yield from host.run_driver(driver)
+
+    run(dut, program(), sck_period)
+    return host.report(sck_period)
+
+
+def benchmark(sck_periods=(7.5, 10, 20, 50, 100, 200), spi_lanes=1):
+    report = {"spi_lanes": spi_lanes, "sys_period_ns": 10, "sck": []}
+    max_dummy = 16
+    # A slower SCK never needs more dummy cycles, so the search starts from the last result
+    for sck_period in sorted(sck_periods):
+        dummy = min_read_dummy(sck_period, spi_lanes, max_dummy=max_dummy)
+        max_dummy = dummy or max_dummy
+        report["sck"].append({
+            "sck_period_ns": sck_period,
+            "sck_mhz": round(1000 / sck_period, 2),
+            "min_read_dummy": dummy,
+            "write_latency_ns": write_latency(sck_period, spi_lanes),
+            "throughput": throughput(sck_period, spi_lanes)
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the SPI link in simulation")
+    parser.add_argument("--sck-period", type=float, action="append",
+                        help="SCK period in ns, can be repeated (default: 7.5, 10, 20, 50, 100, 200)")
+    parser.add_argument("--spi-lanes", type=int, choices=[1, 2, 4], default=1)
+    parser.add_argument("--output", default="bench.json", help="JSON report file")
+    args = parser.parse_args()
+
+    report = benchmark(args.sck_period or (7.5, 10, 20, 50, 100, 200), args.spi_lanes)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    for r in report["sck"]:
+        print("{:7.2f} MHz: min. read dummy {}, write latency {} ns".format(
+            r["sck_mhz"], r["min_read_dummy"], r["write_latency_ns"]))
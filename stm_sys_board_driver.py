@@ -0,0 +1,256 @@
+"""Host side register access over the STM SPI link, using the csr_map.json written by the build.
+
+Reads and writes are queued and sent on ``flush``, coalesced into as few SPI frames as possible:
+accesses to consecutive addresses become one burst, repeated accesses to the same address one fixed
+address burst. Short gaps between reads are read along when the skipped registers have no read side effects.
+The order of the accesses is kept.
+"""
+import json
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+
+def load_csr_map(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def crc8(value, width, crc=0xff):
+    """CRC-8 of the frame header and words built with ``crc`` (polynomial 0x07, MSB first, no final XOR)."""
+    for i in reversed(range(width)):
+        feedback = (crc >> 7 ^ value >> i) & 1
+        crc = (crc << 1 & 0xff) ^ (0x07 if feedback else 0)
+    return crc
+
+
+def frame_header(read, fixed, shadow, address, address_width):
+    """16-bit frame header: r/~w, fixed address, shadow read, padding, address."""
+    assert address < 2 ** address_width
+    return read << 15 | fixed << 14 | shadow << 13 | address
+
+
+def frame_timing(header, lanes=1, read_dummy=12, shadow_dummy=2, data_width=16, crc=False):
+    """SCK clocks of a frame with ``header``: (clocks before the first data word, clocks from one data word
+    to the next, clocks of one data word). With ``crc`` the header and words carry their CRC-8.
+    Words read over Wishbone are padded to ``read_dummy`` clocks."""
+    read = header >> 15 & 1
+    shadow = header >> 13 & 1
+    crc_width = 8 if crc else 0
+    word_clocks = (data_width + crc_width) // lanes
+    header_clocks = (16 + crc_width) // lanes
+    if not read:
+        return header_clocks, word_clocks, word_clocks
+    if shadow:
+        return header_clocks + shadow_dummy, word_clocks, word_clocks
+    return header_clocks + read_dummy, max(word_clocks, read_dummy), word_clocks
+
+
+def frame_clocks(header, words, **timing):
+    """SCK clocks of a frame with ``header`` and ``words`` data words, CS high time not included."""
+    start, stride, word_clocks = frame_timing(header, **timing)
+    return start + ((words - 1) * stride + word_clocks if words else 0)
+
+
+class Transport(ABC):
+    """Moves one SPI frame: the header followed by ``words`` (write) or ``count`` words read back."""
+    @abstractmethod
+    def frame(self, header, words=None, count=0):
+        pass
+
+
+class SimTransport(Transport):
+    """Register model of the gateware side of the frame protocol, counting frames and SCK clocks
+    (``crc``: header and words with CRC-8)."""
+    def __init__(self, csr_map, lanes=1, read_dummy=12, shadow_dummy=2, crc=False):
+        self.address_width = csr_map["address_width"]
+        self.page_width = csr_map["page_width"]
+        self.data_width = csr_map["data_width"]
+        self.timing = dict(lanes=lanes, read_dummy=read_dummy, shadow_dummy=shadow_dummy, data_width=self.data_width,
+                           crc=crc)
+        self.registers = {}
+        self.page = 0
+        self.frames = 0
+        self.clocks = 0
+
+    def _access(self, address, value=None):
+        page_size = 2 ** self.address_width - 1
+        if self.page_width and address == page_size:
+            if value is None:
+                return self.page
+            self.page = value & (2 ** self.page_width - 1)
+            return
+        if self.page_width:
+            address += self.page * page_size
+        if value is None:
+            return self.registers.get(address, 0)
+        self.registers[address] = value
+
+    def frame(self, header, words=None, count=0):
+        read = header >> 15 & 1
+        fixed = header >> 14 & 1
+        address = header & (2 ** self.address_width - 1)
+
+        self.frames += 1
+        self.clocks += frame_clocks(header, count if read else len(words), **self.timing)
+        if read:
+            data = []
+            for i in range(count):
+                data.append(self._access(address))
+                if not fixed:
+                    address = (address + 1) % 2 ** self.address_width
+            return data
+        else:
+            for word in words:
+                self._access(address, word)
+                if not fixed:
+                    address = (address + 1) % 2 ** self.address_width
+
+
+class Result:
+    """Value of a queued read, available after ``flush``."""
+    def __init__(self, words, data_width):
+        self._words = [None] * words
+        self._data_width = data_width
+
+    @property
+    def value(self):
+        if None in self._words:
+            raise ValueError("read not flushed yet")
+        value = 0
+        for word in self._words:
+            value = value << self._data_width | word
+        return value
+
+
+class Frame:
+    """One SPI frame: ``header`` followed by ``words`` written or ``count`` words read."""
+    def __init__(self, header, accesses, words=None, count=0):
+        self.header = header
+        self.accesses = accesses
+        self.words = words
+        self.count = count
+
+    def complete(self, data):
+        """Fill the read results with the words read by the frame."""
+        if self.count:
+            for access, word in zip(self.accesses, data):
+                if access.result is not None:
+                    access.result._words[access.index] = word
+
+
+class _Access:
+    def __init__(self, read, address, shadow=False, word=None, result=None, index=0):
+        self.read = read
+        self.address = address
+        self.shadow = shadow
+        self.word = word
+        self.result = result
+        self.index = index
+
+
+class STMSysBoardDriver:
+    def __init__(self, transport, csr_map, max_gap=2):
+        self.transport = transport
+        self.csr_map = csr_map
+        self.address_width = csr_map["address_width"]
+        self.page_width = csr_map["page_width"]
+        self.data_width = csr_map["data_width"]
+        self.max_gap = max_gap
+        self.registers = {r["name"]: r for r in csr_map["registers"]}
+        self._side_effect = set()
+        for r in csr_map["registers"]:
+            if r["read_side_effect"]:
+                self._side_effect.update(range(r["address"], r["address"] + r["words"]))
+        self._queue = []
+        self._page = None
+
+    def _register(self, name):
+        try:
+            return self.registers[name]
+        except KeyError:
+            raise KeyError("no register {}".format(name)) from None
+
+    def write(self, name, value):
+        """Queue a write of register ``name``, most significant word first."""
+        r = self._register(name)
+        for i in range(r["words"]):
+            shift = (r["words"] - 1 - i) * self.data_width
+            self._queue.append(_Access(False, r["address"] + i, word=value >> shift & (2 ** self.data_width - 1)))
+
+    def read(self, name, shadow=False):
+        """Queue a read of register ``name``, returns a ``Result`` filled on ``flush``."""
+        r = self._register(name)
+        result = Result(r["words"], self.data_width)
+        for i in range(r["words"]):
+            self._queue.append(_Access(True, r["address"] + i, shadow=shadow, result=result, index=i))
+        return result
+
+    def read_now(self, name, shadow=False):
+        result = self.read(name, shadow)
+        self.flush()
+        return result.value
+
+    @contextmanager
+    def batch(self):
+        yield self
+        self.flush()
+
+    def _split(self, address):
+        if not self.page_width:
+            return 0, address
+        page_size = 2 ** self.address_width - 1
+        return address // page_size, address % page_size
+
+    def _can_append(self, frame, access):
+        first = frame[0]
+        last = frame[-1]
+        if access.read != first.read or access.shadow != first.shadow:
+            return None
+        if self._split(access.address)[0] != self._split(first.address)[0]:
+            return None
+        fixed = len(frame) > 1 and frame[1].address == first.address
+        if access.address == last.address and (len(frame) == 1 or fixed):
+            return []
+        if fixed:
+            return None
+        gap = access.address - last.address - 1
+        if gap == 0:
+            return []
+        if access.read and 0 < gap <= self.max_gap:
+            skipped = range(last.address + 1, access.address)
+            if not any(a in self._side_effect for a in skipped):
+                return [_Access(True, a, shadow=access.shadow) for a in skipped]
+        return None
+
+    def take_frames(self):
+        """Take the queued accesses as a list of ``Frame``, to be sent in order."""
+        groups = []
+        for access in self._queue:
+            if groups:
+                gap = self._can_append(groups[-1], access)
+                if gap is not None:
+                    groups[-1] += gap + [access]
+                    continue
+            groups.append([access])
+        self._queue = []
+
+        frames = []
+        for group in groups:
+            first = group[0]
+            page, local = self._split(first.address)
+            if self.page_width and page != self._page:
+                frames.append(Frame(frame_header(False, False, False, 2 ** self.address_width - 1,
+                                                 self.address_width), [], words=[page]))
+                self._page = page
+            fixed = len(group) > 1 and group[1].address == first.address
+            header = frame_header(first.read, fixed, first.shadow, local, self.address_width)
+            if first.read:
+                frames.append(Frame(header, group, count=len(group)))
+            else:
+                frames.append(Frame(header, group, words=[access.word for access in group]))
+        return frames
+
+    def flush(self):
+        """Send all queued accesses."""
+        for frame in self.take_frames():
+            frame.complete(self.transport.frame(frame.header, frame.words, frame.count))
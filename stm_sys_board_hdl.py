@@ -1,77 +1,709 @@
 from migen import *
 from misoc.interconnect import wishbone, csr_bus, wishbone2csr
 from functools import reduce
-from operator import or_
-from misoc.interconnect.csr import CSRStatus, CSRStorage, AutoCSR
+from operator import or_, and_
+from misoc.interconnect.csr import CSR, CSRStatus, CSRStorage, AutoCSR
 from misoc.cores.spi2 import SPIMaster
+from migen.genlib.fifo import SyncFIFO, SyncFIFOBuffered
+from csr_read import ReadCSR, ReadCSRStatus, CSRReadStrobes
 from SpiInterface import SPIInterface
 from spi2wb import SPI2WB
+from csr_map import get_csr_map, write_csr_map
+
+
+# Optional blocks of a slot controller, the GPIO registers (output, input, oe) are always there
+SLOT_FEATURES = ("spi", "interrupts", "events", "counters", "sequencer", "acquire", "filter")
 
 
 class SlotController(Module, AutoCSR):
-    def __init__(self):
+    def __init__(self, fifo_depth=16, event_depth=64, timestamp=None, seq_depth=1024, features=SLOT_FEATURES,
+                 spi_cs=1, acq_depth=1024):
+        self.features = set(features)
+        assert self.features <= set(SLOT_FEATURES), "unknown slot features {}".format(self.features - set(SLOT_FEATURES))
+        # Events are the edges selected by the interrupt mask
+        assert "events" not in self.features or "interrupts" in self.features
+        # Acquisitions are SPI transfers
+        assert "acquire" not in self.features or "spi" in self.features
         self.slot = []
         for j in range(16):
             self.slot.append(TSTriple(name="slot_{j}".format(j=j)))
         self.io_interrupt = Signal()
+        self.interrupt_ack = Signal(16)  # clears interrupt bits from other blocks
 
         # CSRs
-        self.output = CSRStorage(16)
+        self.output = CSRStorage(16, write_from_dev=True)
         self.input = CSRStatus(16)
-        self.oe = CSRStorage(16)
-        self.interrupt = CSRStatus(16)
-        self.interrupt_mask = CSRStorage(16)
-        self.interrupt_clear = CSRStorage(16, write_from_dev=True)
+        self.oe = CSRStorage(16, write_from_dev=True)
+        if "interrupts" in self.features:
+            self.interrupt = ReadCSRStatus(16)
+            self.interrupt_mask = CSRStorage(16, write_from_dev=True)
+            self.interrupt_clear = CSRStorage(16, write_from_dev=True)
 
-        # SPI masters
-        spi_interface = SPIInterface()
-        self.submodules.spi_master = SPIMaster(spi_interface, data_width=16, div_width=8)
-        spi_if_signals = [spi_interface.mosi, spi_interface.miso, spi_interface.cs_spi, spi_interface.clk]
+        if "spi" in self.features:
+            # SPI masters
+            # SPI data goes through TX/RX FIFOs, spi_data replaces the SPIMaster data register in the map
+            self.spi_data = ReadCSR(16)
+            spi_interface = SPIInterface(spi_cs)
+            self.submodules.spi_master = SPIMaster(spi_interface, data_width=16, div_width=8)
+            # spi_length replaces the SPIMaster length register so that a broadcast (SPIBroadcast) can set it
+            self.spi_master.autocsr_exclude = {"data", "length"}
+            self.spi_length = CSRStorage(len(self.spi_master.length.storage), write_from_dev=True)
+            # Broadcast inputs: push a word into the TX FIFO, set the length, hold the TX FIFO
+            self.spi_push = Signal()
+            self.spi_push_data = Signal(16)
+            self.spi_set_length = Signal()
+            self.spi_set_length_data = Signal(len(self.spi_length.storage))
+            self.spi_hold = Signal()
+            # SPI master idle with an empty TX FIFO
+            self.spi_idle = Signal()
+            # Auto-acquire inputs: push a word into the TX FIFO, the word received next goes to the acquisition buffer
+            self.spi_acq_push = Signal()
+            self.spi_acq_push_data = Signal(16)
+            self.spi_acq_take = Signal()
+            # Pulse with the received word in spi_master.data.w
+            self.spi_done = Signal()
+            self.spi_tx_level = CSRStatus(bits_for(fifo_depth))
+            self.spi_rx_level = CSRStatus(bits_for(fifo_depth))
+            self.spi_fifo_overflow = ReadCSRStatus(2)
+            self.add_spi_fifos(fifo_depth)
+            # Pin of each SPI signal, default mosi 0, miso 1, cs0 2, clk 3, cs1.. 4..
+            self.spi_pin_mosi = CSRStorage(4, reset=0)
+            self.spi_pin_miso = CSRStorage(4, reset=1)
+            self.spi_pin_clk = CSRStorage(4, reset=3)
+            for k in range(spi_cs):
+                setattr(self, "spi_pin_cs{}".format(k),
+                        CSRStorage(4, reset=2 if k == 0 else 3 + k, name="spi_pin_cs{}".format(k)))
+        if "interrupts" in self.features:
+            # Reading interrupt clears the bits it returned
+            self.interrupt_read_clear = CSRStorage()
+        if "events" in self.features:
+            # Edge events
+            self.event = ReadCSRStatus(16)
+            self.event_level = CSRStatus(bits_for(event_depth))
+            self.event_overflow = ReadCSRStatus()
+            self.event_enable = CSRStorage()
+        if "counters" in self.features:
+            # Pulse counters and frequency meters
+            self.counter_rising = CSRStorage(16)
+            self.counter_falling = CSRStorage(16)
+            self.counter_clear = CSR(16)
+            self.counter_select = CSRStorage(4)
+            self.counter_low = ReadCSRStatus(16)
+            self.counter_high = CSRStatus(16)
+            self.freq_gate = CSRStorage(32, reset=100000000)
+            self.freq_low = ReadCSRStatus(16)
+            self.freq_high = CSRStatus(16)
+        if "sequencer" in self.features:
+            # Output sequencer
+            self.seq_write_adr = CSRStorage(bits_for(seq_depth - 1))
+            self.seq_data = CSR(16)
+            self.seq_length = CSRStorage(bits_for(seq_depth))
+            self.seq_period = CSRStorage(32, reset=100)
+            self.seq_repeat = CSRStorage(16)
+            self.seq_mask = CSRStorage(16)
+            self.seq_trigger = CSRStorage(5)
+            self.seq_start = CSR()
+            self.seq_running = CSRStatus()
+        if "acquire" in self.features:
+            # Auto-acquire
+            self.acq_enable = CSRStorage()
+            self.acq_period = CSRStorage(32, reset=100)
+            self.acq_word = CSRStorage(16)
+            self.acq_data = ReadCSRStatus(16)
+            self.acq_level = CSRStatus(bits_for(acq_depth))
+            self.acq_overflow = ReadCSRStatus(16)
+        # Set, clear and toggle aliases of the bit registers
+        bit_registers = ["output", "oe"]
+        if "interrupts" in self.features:
+            bit_registers.append("interrupt_mask")
+        for name in bit_registers:
+            for op in ["set", "clear", "toggle"]:
+                setattr(self, "{}_{}".format(name, op), CSR(16, name="{}_{}".format(name, op)))
+        self.add_bit_aliases(bit_registers)
+        if "filter" in self.features:
+            # Input filter
+            self.filter_length = CSRStorage(8)
+            self.filter_mask = CSRStorage(16)
+        if "interrupts" in self.features:
+            # Edges setting interrupts and events
+            self.interrupt_rising = CSRStorage(16, reset=0xffff)
+            self.interrupt_falling = CSRStorage(16, reset=0xffff)
+        output = Signal(16)
+        if "sequencer" in self.features:
+            seq_out = Signal(16)
+            self.comb += output.eq(self.seq_mask.storage & seq_out | ~self.seq_mask.storage & self.output.storage)
+        else:
+            self.comb += output.eq(self.output.storage)
 
-        for i, spi_sig in enumerate(spi_if_signals):
+        if "spi" in self.features:
+            # While SPI is online a pin takes the first of mosi, clk, cs0.., miso routed to it,
+            # the other pins are GPIO
+            online = ~self.spi_master.offline.storage
+            routes = [(self.spi_pin_mosi, spi_interface.mosi.o, spi_interface.mosi.oe),
+                      (self.spi_pin_clk, spi_interface.clk.o, spi_interface.clk.oe)]
+            routes += [(getattr(self, "spi_pin_cs{}".format(k)), spi_interface.cs_spi.o[k], spi_interface.cs_spi.oe)
+                       for k in range(spi_cs)]
+            routes.append((self.spi_pin_miso, spi_interface.miso.o, spi_interface.miso.oe))
+            pins_i = Array(t.i for t in self.slot)
             self.comb += [
-                self.slot[i].o.eq(Mux(self.spi_master.offline.storage,
-                                        self.output.storage[i],
-                                        spi_sig.o)),  # If offline then use register value, else use spi interface
-                self.input.status[i].eq(self.slot[i].i),
-                spi_sig.i.eq(self.slot[i].i),
-                self.slot[i].oe.eq(Mux(self.spi_master.offline.storage,
-                                          self.oe.storage[i],
-                                          spi_sig.oe))
+                spi_interface.mosi.i.eq(pins_i[self.spi_pin_mosi.storage]),
+                spi_interface.miso.i.eq(pins_i[self.spi_pin_miso.storage])
+            ]
+            for i in range(16):
+                o = output[i]
+                oe = self.oe.storage[i]
+                for pin, spi_o, spi_oe in reversed(routes):
+                    o = Mux(online & (pin.storage == i), spi_o, o)
+                    oe = Mux(online & (pin.storage == i), spi_oe, oe)
+                self.comb += [
+                    self.slot[i].o.eq(o),
+                    self.slot[i].oe.eq(oe)
+                ]
+        else:
+            for i in range(16):
+                self.comb += [
+                    self.slot[i].o.eq(output[i]),
+                    self.slot[i].oe.eq(self.oe.storage[i])
+                ]
+        self.comb += self.input.status.eq(Cat(*[t.i for t in self.slot]))
+
+        # Input levels seen by interrupts, events, counters and sequencer triggers
+        level = Signal(16)
+        prev_level = Signal(16)
+        self.sync.sys += prev_level.eq(level)
+        if "filter" in self.features:
+            self.add_input_filter(self.input.status, level)
+        else:
+            self.sync.sys += level.eq(self.input.status)
+
+        if "interrupts" in self.features:
+            self.comb += self.io_interrupt.eq(reduce(or_, self.interrupt.status & self.interrupt_mask.storage))
+
+            # Interrupts
+            # TODO: do not trigger interrupt on spi pins if spi is active
+            read_clear = Signal(16)
+            self.comb += read_clear.eq(Replicate(self.interrupt_read_clear.storage & self.interrupt.read, 16) &
+                                       self.interrupt.read_data)
+            masked_edge = Signal(16)
+            self.comb += masked_edge.eq((level & ~prev_level & self.interrupt_rising.storage |
+                                         ~level & prev_level & self.interrupt_falling.storage) &
+                                        self.interrupt_mask.storage & ~self.oe.storage)
+            for i in range(16):
+                self.sync.sys += If(masked_edge[i],
+                       self.interrupt.status[i].eq(1),
+                    ).Elif(self.interrupt_clear.storage[i] | self.interrupt_ack[i] | read_clear[i],
+                       self.interrupt.status[i].eq(0)
+                    )
+            # Clearing interrupt clear register
+            self.sync.sys += [
+                self.interrupt_clear.dat_w.eq(0),
+                self.interrupt_clear.we.eq(0),
+                If(self.interrupt_clear.re,
+                    self.interrupt_clear.we.eq(1)
+                )
             ]
-        for i in range(4, 16):
+
+        if "events" in self.features:
+            if timestamp is None:
+                timestamp = Signal(43)
+                self.sync.sys += timestamp.eq(timestamp + 1)
+            self.add_event_fifo(event_depth, timestamp, masked_edge, level)
+        if "counters" in self.features:
+            self.add_counters(level & ~prev_level & self.counter_rising.storage |
+                              ~level & prev_level & self.counter_falling.storage)
+        if "sequencer" in self.features:
+            self.add_sequencer(seq_depth, seq_out, level & ~prev_level)
+        if "acquire" in self.features:
+            self.add_acquisition(acq_depth)
+
+    def add_bit_aliases(self, names):
+        # Writing <name>_set, <name>_clear or <name>_toggle sets, clears or toggles the bits of the mask written
+        # in register <name> in one cycle, the other bits keep their value
+        for name in names:
+            reg = getattr(self, name)
+            set_, clear, toggle = [getattr(self, "{}_{}".format(name, op)) for op in ["set", "clear", "toggle"]]
             self.comb += [
-                self.slot[i].o.eq(self.output.storage[i]),
-                self.input.status[i].eq(self.slot[i].i),
-                self.slot[i].oe.eq(self.oe.storage[i]),
+                reg.we.eq(set_.re | clear.re | toggle.re),
+                reg.dat_w.eq(Mux(set_.re, reg.storage | set_.r,
+                                 Mux(clear.re, reg.storage & ~clear.r, reg.storage ^ toggle.r)))
             ]
-        self.comb += self.io_interrupt.eq(reduce(or_, self.interrupt.status & self.interrupt_mask.storage))
 
-        # Interrupts
-        # TODO: do not trigger interrupt on spi pins if spi is active
+    def add_input_filter(self, pins, level):
+        # Pins set in filter_mask take a new level once the input kept it for filter_length sys cycles,
+        # shorter pulses are dropped. The other pins (and filter_length 0 or 1) follow the input.
+        for i in range(16):
+            cnt = Signal(8)
+            self.sync.sys += If(~self.filter_mask.storage[i] | (pins[i] == level[i]),
+                    level[i].eq(pins[i]),
+                    cnt.eq(1)
+                ).Elif(cnt >= self.filter_length.storage,
+                    level[i].eq(pins[i]),
+                    cnt.eq(1)
+                ).Else(
+                    cnt.eq(cnt + 1)
+                )
+
+    def add_event_fifo(self, depth, timestamp, edges, level):
+        # Each masked edge is queued as (pin, polarity, 43 bit timestamp) and read from event as three words:
+        # timestamp[15:0], timestamp[31:16], Cat(timestamp[42:32], polarity, pin). Reads 0 when empty.
+        # Edges on a pin whose previous edge is not queued yet are lost and flagged in event_overflow.
+        self.submodules.event_fifo = fifo = SyncFIFOBuffered(48, depth)
+        pending = Signal(16)
+        polarity = Signal(16)
+        stamps = Array(Signal(43) for i in range(16))
+        pin = Signal(4)
+        pushed = Signal(16)
+        lost = Signal()
+
+        self.comb += pin.eq(0)
+        for i in reversed(range(16)):
+            self.comb += If(pending[i], pin.eq(i))
+        self.comb += [
+            fifo.din.eq(Cat(stamps[pin], Array(polarity)[pin], pin)),
+            fifo.we.eq(pending != 0),
+            pushed.eq(Mux(fifo.writable & (pending != 0), 1 << pin, 0)),
+            lost.eq((edges & Replicate(self.event_enable.storage, 16) & pending & ~pushed) != 0)
+        ]
         for i in range(16):
-            edge = Signal(2)
             self.sync.sys += [
-                edge[1].eq(edge[0]),
-                edge[0].eq(self.input.status[i]),
-                If((edge[0] ^ edge[1]) & (self.interrupt_mask.storage[i] & (~self.oe.storage[i])),
-                   self.interrupt.status[i].eq(1),
-                ).Elif(self.interrupt_clear.storage[i],
-                   self.interrupt.status[i].eq(0)
+                If(pushed[i],
+                    pending[i].eq(0)
+                ),
+                If(edges[i] & self.event_enable.storage & (~pending[i] | pushed[i]),
+                    pending[i].eq(1),
+                    polarity[i].eq(level[i]),
+                    stamps[i].eq(timestamp)
                 )
             ]
-        # Clearing interrupt clear register
+
+        word = Signal(2)
+        words = Array([fifo.dout[:16], fifo.dout[16:32], fifo.dout[32:]])
+        read = self.event.popped(fifo.readable)
+        self.comb += [
+            self.event.status.eq(Mux(fifo.readable, words[word], 0)),
+            fifo.re.eq(read & (word == 2)),
+            self.event_level.status.eq(fifo.level)
+        ]
+        self.sync.sys += [
+            If(read,
+                If(word == 2,
+                    word.eq(0)
+                ).Else(
+                    word.eq(word + 1)
+                )
+            ),
+            If(lost,
+                self.event_overflow.status.eq(1)
+            ).Elif(self.event_overflow.read,
+                self.event_overflow.status.eq(0)
+            )
+        ]
+
+    def add_counters(self, edges):
+        # 32 bit count of the selected edges of each pin, and the count over the last freq_gate sys cycles
+        # (writing freq_gate restarts the gate).
+        # counter_select picks the pin read from counter_low/high and freq_low/high. Reading the low word
+        # latches the matching high word, so read low then high.
+        counters = Array(Signal(32) for i in range(16))
+        gated = Array(Signal(32) for i in range(16))
+        freqs = Array(Signal(32) for i in range(16))
+        gate_cnt = Signal(32)
+        gate_end = Signal()
+
+        self.comb += gate_end.eq((gate_cnt == 0) | self.freq_gate.re)
+        self.sync.sys += If(gate_end,
+                gate_cnt.eq(self.freq_gate.storage - 1)
+            ).Else(
+                gate_cnt.eq(gate_cnt - 1)
+            )
+        for i in range(16):
+            self.sync.sys += [
+                If(self.counter_clear.re & self.counter_clear.r[i],
+                    counters[i].eq(0)
+                ).Elif(edges[i],
+                    counters[i].eq(counters[i] + 1)
+                ),
+                If(gate_end,
+                    freqs[i].eq(gated[i] + edges[i]),
+                    gated[i].eq(0)
+                ).Elif(edges[i],
+                    gated[i].eq(gated[i] + 1)
+                )
+            ]
+
+        # The low word was sampled before the read strobe, take the high word it belongs to:
+        # the counter carried if its low word is now below the one read,
+        # the frequency may have been replaced by a new gate result
+        counter = Signal(32)
+        freq = Signal(32)
+        prev_freq = Signal(32)
+        self.comb += [
+            counter.eq(counters[self.counter_select.storage]),
+            freq.eq(freqs[self.counter_select.storage]),
+            self.counter_low.status.eq(counter[:16]),
+            self.freq_low.status.eq(freq[:16])
+        ]
+        self.sync.sys += [
+            If(gate_end,
+                prev_freq.eq(freq)
+            ),
+            If(self.counter_low.read,
+                self.counter_high.status.eq(counter[16:] - (counter[:16] < self.counter_low.read_data))
+            ),
+            If(self.freq_low.read,
+                self.freq_high.status.eq(Mux(freq[:16] == self.freq_low.read_data, freq[16:], prev_freq[16:]))
+            )
+        ]
+
+    def add_sequencer(self, depth, out, rising):
+        # Words written to seq_data are stored from seq_write_adr on. Writing 1 to seq_start (or a rising edge
+        # of the pin selected in seq_trigger, bit 4 enables it) plays seq_length words, one every seq_period sys
+        # cycles (at least 2), seq_repeat times (0 = until 0 is written to seq_start). Output pins set in
+        # seq_mask follow the played words, the last word is kept when the sequence ends.
+        mem = Memory(16, depth)
+        wr = mem.get_port(write_capable=True)
+        rd = mem.get_port()
+        self.specials += mem, wr, rd
+
+        self.sync.sys += If(self.seq_write_adr.re,
+                wr.adr.eq(self.seq_write_adr.storage)
+            ).Elif(self.seq_data.re,
+                wr.adr.eq(wr.adr + 1)
+            )
+        self.comb += [
+            wr.we.eq(self.seq_data.re),
+            wr.dat_w.eq(self.seq_data.r)
+        ]
+
+        running = Signal()
+        start = Signal()
+        tick = Signal()
+        cnt = Signal(32)
+        repeats = Signal(16)
+        adr = Signal(len(rd.adr))
+        last = Signal()
+        self.comb += [
+            start.eq(self.seq_start.re & self.seq_start.r |
+                     self.seq_trigger.storage[4] & Array(rising)[self.seq_trigger.storage[:4]] & ~running),
+            tick.eq(running & (cnt == 0)),
+            last.eq(adr == self.seq_length.storage - 1),
+            rd.adr.eq(adr),
+            self.seq_running.status.eq(running)
+        ]
+        self.sync.sys += [
+            If(start,
+                running.eq(self.seq_length.storage != 0),
+                adr.eq(0),
+                cnt.eq(1),
+                repeats.eq(self.seq_repeat.storage)
+            ).Elif(self.seq_start.re,
+                running.eq(0)
+            ).Elif(tick,
+                out.eq(rd.dat_r),
+                cnt.eq(Mux(self.seq_period.storage > 1, self.seq_period.storage - 1, 1)),
+                If(last,
+                    adr.eq(0),
+                    If(repeats == 1,
+                        running.eq(0)
+                    ),
+                    If(repeats != 0,
+                        repeats.eq(repeats - 1)
+                    )
+                ).Else(
+                    adr.eq(adr + 1)
+                )
+            ).Elif(running,
+                cnt.eq(cnt - 1)
+            )
+        ]
+
+    def add_spi_fifos(self, depth):
+        # Words written to spi_data (or pushed by a broadcast) are queued and sent one by one as soon as
+        # the SPI master is writable and spi_hold is low, received words are queued for reading from spi_data
+        # (reads 0 when empty).
+        # Overflowing words are dropped and flagged in spi_fifo_overflow (bit 0 TX, bit 1 RX), cleared on read.
+        self.submodules.spi_tx_fifo = tx = SyncFIFO(16, depth)
+        self.submodules.spi_rx_fifo = rx = SyncFIFO(16, depth)
+        spi_data = self.spi_master.data
+        loaded = Signal()
+        started = Signal()
+        done = Signal()
+        self.comb += [
+            tx.we.eq(self.spi_data.re | self.spi_push | self.spi_acq_push),
+            tx.din.eq(Mux(self.spi_push, self.spi_push_data, Mux(self.spi_acq_push, self.spi_acq_push_data,
+                                                                  self.spi_data.r))),
+            self.spi_data.w.eq(Mux(rx.readable, rx.dout, 0)),
+            rx.re.eq(self.spi_data.popped(rx.readable)),
+
+            spi_data.re.eq(tx.readable & self.spi_master.writable.status & ~loaded & ~self.spi_hold),
+            spi_data.r.eq(tx.dout),
+            tx.re.eq(spi_data.re),
+
+            done.eq(started & self.spi_master.readable.status),
+            self.spi_done.eq(done),
+            rx.we.eq(done & ~self.spi_acq_take),
+            rx.din.eq(spi_data.w),
+
+            self.spi_tx_level.status.eq(tx.level),
+            self.spi_rx_level.status.eq(rx.level),
+            self.spi_idle.eq(~tx.readable & ~loaded & self.spi_master.idle.status)
+        ]
+        # The SPIMaster length register follows spi_length
+        length = self.spi_master.length
+        length.finalize(16)
+        self.submodules += length
+        self.comb += [
+            length.get_simple_csrs()[0].re.eq(1),
+            length.get_simple_csrs()[0].r.eq(self.spi_length.storage),
+            self.spi_length.we.eq(self.spi_set_length),
+            self.spi_length.dat_w.eq(self.spi_set_length_data)
+        ]
+        # A transfer is finished when readable drops after loading and comes back
+        self.sync.sys += [
+            If(spi_data.re,
+                loaded.eq(1)
+            ).Elif(loaded & ~self.spi_master.readable.status,
+                started.eq(1)
+            ).Elif(done,
+                loaded.eq(0),
+                started.eq(0)
+            ),
+            If(tx.we & ~tx.writable,
+                self.spi_fifo_overflow.status[0].eq(1)
+            ).Elif(self.spi_fifo_overflow.read,
+                self.spi_fifo_overflow.status[0].eq(0)
+            ),
+            If(rx.we & ~rx.writable,
+                self.spi_fifo_overflow.status[1].eq(1)
+            ).Elif(self.spi_fifo_overflow.read,
+                self.spi_fifo_overflow.status[1].eq(0)
+            )
+        ]
+
+    def add_acquisition(self, depth):
+        # With acq_enable set, acq_word is sent every acq_period sys cycles (at least 2) and the received words
+        # are queued in a block RAM buffer of depth words, drained by reading acq_data (reads 0 when empty,
+        # read acq_level first). Acquisitions start only when the SPI master is idle with an empty TX FIFO.
+        # acq_overflow counts the lost samples (buffer full, or SPI still busy at the next period), reading it
+        # subtracts the count returned.
+        self.submodules.acq_fifo = fifo = SyncFIFOBuffered(16, depth)
+        cnt = Signal(32)
+        tick = Signal()
+        pending = Signal()
+        lost = Signal(2)
+        self.comb += [
+            tick.eq(self.acq_enable.storage & (cnt == 0)),
+            # Host and broadcast words take the TX FIFO first
+            self.spi_acq_push.eq(tick & self.spi_idle & ~self.spi_data.re & ~self.spi_push),
+            self.spi_acq_push_data.eq(self.acq_word.storage),
+            # Acquisitions start with an empty TX FIFO, so the next word received is the sample
+            self.spi_acq_take.eq(pending),
+            fifo.we.eq(self.spi_done & pending),
+            fifo.din.eq(self.spi_master.data.w),
+            self.acq_data.status.eq(Mux(fifo.readable, fifo.dout, 0)),
+            fifo.re.eq(self.acq_data.popped(fifo.readable)),
+            self.acq_level.status.eq(fifo.level),
+            lost.eq((tick & ~self.spi_acq_push) + (fifo.we & ~fifo.writable))
+        ]
+        overflow = self.acq_overflow.status
         self.sync.sys += [
-            self.interrupt_clear.dat_w.eq(0),
-            self.interrupt_clear.we.eq(0),
-            If(self.interrupt_clear.re,
-                self.interrupt_clear.we.eq(1)
+            If(~self.acq_enable.storage | (cnt == 0),
+                cnt.eq(Mux(self.acq_period.storage > 1, self.acq_period.storage - 1, 1))
+            ).Else(
+                cnt.eq(cnt - 1)
+            ),
+            If(self.spi_acq_push,
+                pending.eq(1)
+            ).Elif(self.spi_done,
+                pending.eq(0)
+            ),
+            If(self.acq_overflow.read,
+                overflow.eq(overflow - self.acq_overflow.read_data + lost)
+            ).Elif(overflow + lost <= 0xffff,
+                overflow.eq(overflow + lost)
             )
         ]
 
 
+class GPIOSnapshot(Module, AutoCSR):
+    """Writing ``latch`` copies input and interrupt of all slots on the same cycle
+    into a contiguous window (input0..N-1, interrupt0..N-1) for one burst read."""
+    def __init__(self, slots):
+        self.latch = CSR()
+        for i, slot in enumerate(slots):
+            if slot is not None:
+                setattr(self, "input{}".format(i), CSRStatus(len(slot.input.status), name="input{}".format(i)))
+        for i, slot in enumerate(slots):
+            if slot is not None and "interrupts" in slot.features:
+                setattr(self, "interrupt{}".format(i), CSRStatus(len(slot.interrupt.status),
+                                                                 name="interrupt{}".format(i)))
+
+        for i, slot in enumerate(slots):
+            if slot is not None:
+                self.sync.sys += If(self.latch.re, getattr(self, "input{}".format(i)).status.eq(slot.input.status))
+            if slot is not None and "interrupts" in slot.features:
+                self.sync.sys += If(self.latch.re,
+                                    getattr(self, "interrupt{}".format(i)).status.eq(slot.interrupt.status))
+
+
+class InterruptController(Module, AutoCSR):
+    """Interrupt summary (one bit per slot with a pending unmasked interrupt) and
+    vector of the first pending slot/pin (bit 15 pending, bits 6-4 slot, bits 3-0 pin).
+
+    The vector holds its slot/pin while it is pending. With ``vector_clear`` set,
+    reading the vector clears the interrupt it returned."""
+    def __init__(self, slots):
+        self.summary = CSRStatus(len(slots))
+        self.vector = ReadCSRStatus(16)
+        self.vector_clear = CSRStorage()
+
+        slots = [slot if slot is not None and "interrupts" in slot.features else None for slot in slots]
+        pending = Cat(*[Constant(0, 16) if slot is None else slot.interrupt.status & slot.interrupt_mask.storage
+                        for slot in slots])
+        enc = Signal(max=len(pending))
+        enc_valid = Signal()
+        self.comb += [enc.eq(0), enc_valid.eq(0)]
+        for n in reversed(range(len(pending))):
+            self.comb += If(pending[n], enc.eq(n), enc_valid.eq(1))
+
+        held = Signal()
+        held_n = Signal(max=len(pending))
+        held_pending = Signal()
+        n = Signal(max=len(pending))
+        valid = Signal()
+        # Clear the interrupt in the vector handed to the host, not the current one
+        ack = Signal()
+        ack_n = Signal(max=len(pending))
+        self.comb += [
+            self.summary.status.eq(Cat(*[Constant(0, 1) if slot is None else slot.io_interrupt for slot in slots])),
+            held_pending.eq(held & Array(pending)[held_n]),
+            n.eq(Mux(held_pending, held_n, enc)),
+            valid.eq(held_pending | enc_valid),
+            self.vector.status.eq(Cat(n, Replicate(0, 15 - len(n)), valid)),
+            ack.eq(self.vector.read & self.vector_clear.storage & self.vector.read_data[15]),
+            ack_n.eq(self.vector.read_data[:len(ack_n)])
+        ]
+        self.sync.sys += [
+            held.eq(valid & ~(ack & (ack_n == n))),
+            held_n.eq(n)
+        ]
+        for j, slot in enumerate(slots):
+            if slot is not None:
+                self.comb += slot.interrupt_ack.eq(Cat(*[ack & (ack_n == 16*j + k) for k in range(16)]))
+
+
+class SPIBroadcast(Module, AutoCSR):
+    """SPI transfers on several slots at once. ``mask`` selects the slots (bit n = slot n + 1),
+    writing ``length`` sets their SPI length and writing ``data`` queues the word in their TX FIFOs,
+    all on the same cycle. Idle slots start the transfer together; with ``hold`` set the selected slots
+    keep their queued words until ``hold`` is cleared. ``idle`` is set when all selected slots are idle
+    with empty TX FIFOs."""
+    def __init__(self, slots):
+        slots = [slot if slot is not None and "spi" in slot.features else None for slot in slots]
+        length_width = max(len(slot.spi_length.storage) for slot in slots if slot is not None)
+        self.mask = CSRStorage(len(slots))
+        self.length = CSRStorage(length_width)
+        self.data = CSR(16)
+        self.hold = CSRStorage()
+        self.idle = CSRStatus()
+
+        idle = []
+        for j, slot in enumerate(slots):
+            if slot is None:
+                continue
+            selected = self.mask.storage[j]
+            self.comb += [
+                slot.spi_push.eq(self.data.re & selected),
+                slot.spi_push_data.eq(self.data.r),
+                slot.spi_set_length.eq(self.length.re & selected),
+                slot.spi_set_length_data.eq(self.length.storage),
+                slot.spi_hold.eq(self.hold.storage & selected)
+            ]
+            idle.append(slot.spi_idle | ~selected)
+        self.comb += self.idle.status.eq(reduce(and_, idle))
+
+
+class PerfCounters(Module, AutoCSR):
+    """32 bit counters of the SPI link activity (the SPI2WB activity outputs, connected to the signals of the same name)
+    and of the busy cycles of the slot SPI masters.
+
+    Writing ``latch`` copies all counters on the same cycle into the status registers, read in one burst;
+    with bit 0 of the value written the counters restart from 0 on that cycle, so no event is lost between
+    two latches. ``cycles`` counts sys cycles (10 ns) to turn the counts into rates and utilisation."""
+    def __init__(self, slots):
+        self.frame_strobe = Signal()
+        self.read_strobe = Signal()
+        self.write_strobe = Signal()
+        self.bus_wait = Signal()
+        self.late_read = Signal()
+
+        self.latch = CSR()
+        events = [
+            ("cycles", 1),
+            ("frames", self.frame_strobe),
+            ("reads", self.read_strobe),
+            ("writes", self.write_strobe),
+            ("bus_wait_cycles", self.bus_wait),
+            ("late_reads", self.late_read)
+        ]
+        events += [("spi_busy{}".format(i), ~slot.spi_master.idle.status) for i, slot in enumerate(slots)
+                   if slot is not None and "spi" in slot.features]
+
+        for name, event in events:
+            counter = Signal(32)
+            status = CSRStatus(32, name=name)
+            setattr(self, name, status)
+            # One bit, also for inverted inputs
+            pulse = Signal()
+            self.comb += pulse.eq(event)
+            event = pulse
+            self.sync.sys += [
+                If(self.latch.re & self.latch.r,
+                    counter.eq(event)
+                ).Else(
+                    counter.eq(counter + event)
+                ),
+                If(self.latch.re,
+                    status.status.eq(counter + event)
+                )
+            ]
+
+
+class WishbonePager(Module):
+    """Maps the ``address_width`` bit bus of the SPI bridge onto pages of ``2**address_width - 1``
+    registers of ``bus``. The last address of every page is the page register."""
+    def __init__(self, bus, address_width, page_width, read_adr):
+        self.bus = wishbone.Interface(data_width=len(bus.dat_w), adr_width=address_width)
+        self.page = Signal(page_width)
+        self.read_adr = Signal(len(bus.adr))
+
+        page_size = 2 ** address_width - 1
+        page_sel = Signal()
+        self.comb += [
+            page_sel.eq(self.bus.adr == page_size),
+            bus.adr.eq(self.page * page_size + self.bus.adr),
+            bus.dat_w.eq(self.bus.dat_w),
+            bus.sel.eq(self.bus.sel),
+            bus.we.eq(self.bus.we),
+            bus.cyc.eq(self.bus.cyc & ~page_sel),
+            bus.stb.eq(self.bus.stb & ~page_sel),
+            self.bus.dat_r.eq(Mux(page_sel, self.page, bus.dat_r)),
+            self.bus.ack.eq(Mux(page_sel, self.bus.cyc & self.bus.stb, bus.ack)),
+            self.read_adr.eq(self.page * page_size + read_adr)
+        ]
+        self.sync.sys += If(page_sel & self.bus.cyc & self.bus.stb & self.bus.we,
+            self.page.eq(self.bus.dat_w)
+        )
+
+
 class STMSysBoard(Module, AutoCSR):
-    def __init__(self, platform):
+    """``slots`` maps the slot index (connector number - 1) of each slot controller to its features
+    (``SLOT_FEATURES``), default: all 8 slots with all features. Connectors without controller are left unused.
+    ``spi_cs`` is the number of chip selects of the slot SPI masters. With ``crc`` the SPI frames carry CRC-8
+    trailers (see ``SPI2WB``) and rejected headers and write words are counted in ``crc_errors``.
+    ``perf`` adds the link and SPI master activity counters (``PerfCounters``)."""
+    def __init__(self, platform, spi_lanes=1, address_width=10, page_width=0, slots=None, spi_cs=1, crc=False,
+                 perf=False):
         self.spi_clk = Signal()
         self.specials += Instance("GSR", i_GSR=~ResetSignal(), name="GSR_INST")
         self.specials += Instance("PUR", i_PUR=~ResetSignal(), name="PUR_INST")
@@ -88,34 +720,28 @@ class STMSysBoard(Module, AutoCSR):
         ]
         platform.add_period_constraint(platform.lookup_request("clk100", loose=True), 10)
 
-        self.address_reg_len = 7
-        self.csr_bus = csr_bus.Interface(data_width=16, address_width=self.address_reg_len)
-        self.wishbone = wishbone.Interface(data_width=16, adr_width=self.address_reg_len)
-        self.submodules.buses = wishbone2csr.WB2CSR(bus_wishbone=self.wishbone, bus_csr=self.csr_bus)
-
-        for i in range(8):
-            setattr(self, "logic{}".format(i), SlotController())
-            self.submodules += getattr(self, "logic{}".format(i))
-
-        self.id = CSRStatus(16)
-        self.id2 = CSRStatus(16)
-        self.comb += self.id.status.eq(0xaaaa)
-        self.comb += self.id2.status.eq(0x5555)
+        if slots is None:
+            slots = {i: SLOT_FEATURES for i in range(8)}
+        self.add_core(platform, spi_lanes, address_width, page_width, slots, spi_cs=spi_cs, crc=crc, perf=perf)
 
-        self.submodules.csrs = csr_bus.CSRBank(self.get_csrs(), address=0, bus=self.csr_bus,
-                                               align_bits=12 - self.address_reg_len)
-        print("# of registers:", len(self.get_csrs()))
-        # TODO: increase address length
-        # assert len(self.get_csrs()) < 2 ** (self.address_reg_len)
-
-        # SPI Slave
-        # TODO: add support to x2 and x4 SPI (QSPI)
-        spi = platform.request("qspix1", 0)
-        self.submodules.spi_slave = SPI2WB(platform=platform, wb_bus=self.wishbone, address_width=self.address_reg_len)
+        if spi_lanes == 1:
+            spi = platform.request("qspix1", 0)
+            self.comb += [
+                self.spi_slave.sdi.eq(spi.mosi),
+                spi.miso.eq(self.spi_slave.sdo)
+            ]
+        else:
+            # Dual/quad SPI, data lines are bidirectional
+            spi = platform.request("qspix4", 0)
+            spi_data = TSTriple(len(spi.data))
+            self.specials += spi_data.get_tristate(spi.data)
+            self.comb += [
+                self.spi_slave.sdi.eq(spi_data.i[:spi_lanes]),
+                spi_data.o[:spi_lanes].eq(self.spi_slave.sdo),
+                spi_data.oe.eq(self.spi_slave.sdo_oe)
+            ]
         self.comb += [
-            self.spi_slave.sdi.eq(spi.mosi),
             self.spi_slave.sel.eq(~spi.cs_n),
-            spi.miso.eq(self.spi_slave.sdo),
             self.spi_clk.eq(spi.clk)
         ]
         platform.add_period_constraint(spi.clk, 1000/133)
@@ -127,7 +753,7 @@ class STMSysBoard(Module, AutoCSR):
         # interrupts += spi_sig
         interrupts = Cat(interrupts, spi_sig)
 
-        for i in range(8):
+        for i in sorted(slots):
             connector_num = i+1
             silpa_outputs = [0, 1, 3, 6, 7]
             platform.add_extension(handle_connector_mess(connector_num, silpa_outputs))
@@ -170,6 +796,91 @@ class STMSysBoard(Module, AutoCSR):
         self.sync.stm += fsen.eq(~fsen)
 
 
+    def add_core(self, platform, spi_lanes, address_width, page_width, slots=8, read_dummy=12, spi_cs=1, crc=False,
+                 perf=False):
+        # Slot controllers, board registers, CSR bank and SPI bridge (platform None: simulation)
+        # slots: slot index -> features, or a number of slots with all features
+        # SPI frame address, optionally extended by a page register
+        self.address_reg_len = address_width
+        bus_address_len = address_width + page_width
+        # CSRBank decodes at most 11 address bits
+        assert bus_address_len <= 11
+        self.csr_bus = csr_bus.Interface(data_width=16, address_width=bus_address_len + 1)
+        self.wishbone = wishbone.Interface(data_width=16, adr_width=bus_address_len)
+        self.submodules.buses = wishbone2csr.WB2CSR(bus_wishbone=self.wishbone, bus_csr=self.csr_bus)
+
+        # Shared 100 MHz timestamp for slot events
+        self.timestamp = Signal(43)
+        self.sync.sys += self.timestamp.eq(self.timestamp + 1)
+
+        if isinstance(slots, int):
+            slots = {i: SLOT_FEATURES for i in range(slots)}
+        for i in sorted(slots):
+            setattr(self, "logic{}".format(i), SlotController(timestamp=self.timestamp, features=slots[i],
+                                                                 spi_cs=spi_cs))
+            self.submodules += getattr(self, "logic{}".format(i))
+        # Slot controller list passed to the board register blocks below (GPIOSnapshot, InterruptController,
+        # SPIBroadcast, PerfCounters): slots are numbered by their position, None for a missing slot
+        slot_controllers = [getattr(self, "logic{}".format(i), None) for i in range(max(slots) + 1)]
+
+        self.id = CSRStatus(16)
+        self.id2 = CSRStatus(16)
+        self.comb += self.id.status.eq(0xaaaa)
+        self.comb += self.id2.status.eq(0x5555)
+
+        self.submodules.snapshot = GPIOSnapshot(slot_controllers)
+        if any("interrupts" in features for features in slots.values()):
+            self.submodules.interrupts = InterruptController(slot_controllers)
+        if any("spi" in features for features in slots.values()):
+            self.submodules.spi_broadcast = SPIBroadcast(slot_controllers)
+        if crc:
+            # Rejected SPI frame headers and write words, reading subtracts the returned count
+            self.crc_errors = ReadCSRStatus(16)
+        if perf:
+            self.submodules.perf = PerfCounters(slot_controllers)
+
+        csrs = self.get_csrs()
+        self.submodules.csrs = csr_bus.CSRBank(csrs, address=0, bus=self.csr_bus,
+                                               align_bits=11 - bus_address_len)
+        self.csr_map = get_csr_map(self.csrs, csrs, address_width, page_width)
+        registers = len(self.csrs.simple_csrs)
+        print("# of registers:", registers)
+        if page_width:
+            assert registers <= (2 ** address_width - 1) * 2 ** page_width, \
+                "{} registers do not fit in {} pages of {} bit address".format(registers, 2 ** page_width, address_width)
+        else:
+            assert registers <= 2 ** address_width, \
+                "{} registers do not fit in {} bit address".format(registers, address_width)
+
+        # SPI Slave
+        if page_width:
+            spi_wb = wishbone.Interface(data_width=16, adr_width=address_width)
+            shadow_depth = 2 ** address_width
+        else:
+            spi_wb = self.wishbone
+            shadow_depth = registers
+        self.submodules.spi_slave = SPI2WB(platform=platform, wb_bus=spi_wb, address_width=self.address_reg_len,
+                                           read_dummy=read_dummy, lanes=spi_lanes, shadow=True,
+                                           shadow_depth=shadow_depth, crc=crc)
+        read_adr = self.spi_slave.read_adr
+        if page_width:
+            self.submodules.pager = WishbonePager(self.wishbone, address_width, page_width, self.spi_slave.read_adr)
+            self.comb += spi_wb.connect(self.pager.bus)
+            read_adr = self.pager.read_adr
+        self.submodules += CSRReadStrobes(self.csrs, csrs, self.spi_slave.read_strobe,
+                                          read_adr, self.spi_slave.read_data,
+                                          self.spi_slave.fetch_strobe, self.wishbone.adr)
+        if perf:
+            self.comb += [getattr(self.perf, name).eq(getattr(self.spi_slave, name))
+                          for name in ["frame_strobe", "read_strobe", "write_strobe", "bus_wait", "late_read"]]
+        if crc:
+            errors = self.crc_errors.status
+            self.sync.sys += If(self.crc_errors.read,
+                    errors.eq(errors - self.crc_errors.read_data + self.spi_slave.crc_error)
+                ).Elif(self.spi_slave.crc_error & (errors != 0xffff),
+                    errors.eq(errors + 1)
+                )
+
     def connect_extension(self, slot_controller, external_signals, outputs, external_interrupt, connector_num):
         internal_interrupt = slot_controller.io_interrupt
         internal_signals = slot_controller.slot
@@ -228,12 +939,63 @@ class LatticeECP5TrellisTristateDiamond(Module):
 
 if __name__ == "__main__":
     from stm_sys_board import Platform
+    from build_cache import cached_build, default_cache_dir
+    import argparse
+    parser = argparse.ArgumentParser(description="Build STM system board gateware")
+    parser.add_argument("--spi-lanes", type=int, choices=[1, 2, 4], default=1,
+                        help="data lines of the STM SPI link: 1 (SPI), 2 (dual SPI) or 4 (quad SPI)")
+    parser.add_argument("--address-width", type=int, default=10,
+                        help="register address bits in the SPI frame (max. 11 including page bits)")
+    parser.add_argument("--page-width", type=int, default=0,
+                        help="bits of the page register extending the address (0 = no paging)")
+    parser.add_argument("--slots", default="1,2,3,4,5,6,7,8",
+                        help="connectors with a slot controller, comma separated (default: %(default)s)")
+    parser.add_argument("--features", default=",".join(SLOT_FEATURES),
+                        help="features of the slot controllers, comma separated from {} or gpio for none "
+                             "(default: all)".format(", ".join(SLOT_FEATURES)))
+    parser.add_argument("--slot-features", action="append", default=[], metavar="N=FEATURES",
+                        help="features of the slot controller on connector N instead of --features, can be repeated")
+    parser.add_argument("--spi-cs", type=int, default=1, help="chip selects of each slot SPI master (default: 1)")
+    parser.add_argument("--crc", action="store_true", help="CRC-8 on the SPI frame header and data words")
+    parser.add_argument("--perf", action="store_true", help="performance counters of the SPI link and SPI masters")
+    parser.add_argument("--cache-dir", default=default_cache_dir(),
+                        help="cache of synthesis, place and route and bitstream results (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="run all toolchain stages without the cache")
+    parser.add_argument("--seeds", type=int, default=1,
+                        help="place and route with seeds 1 to n in parallel and keep the one with the best slack")
+    parser.add_argument("--jobs", type=int, default=None, help="parallel place and route runs (default: CPU count)")
+    parser.add_argument("--baseline", default="report_baseline.json",
+                        help="timing and resource report to compare the build with (default: %(default)s)")
+    parser.add_argument("--update-baseline", action="store_true", help="store the report of this build as the baseline")
+    args = parser.parse_args()
+
+    def features(names):
+        return tuple(name for name in names.split(",") if name and name != "gpio")
+    slots = {int(n) - 1: features(args.features) for n in args.slots.split(",")}
+    for option in args.slot_features:
+        n, names = option.split("=")
+        assert int(n) - 1 in slots, "no slot controller on connector {}".format(n)
+        slots[int(n) - 1] = features(names)
+
     platform = Platform()
-    stm_sys_board = STMSysBoard(platform)
+    stm_sys_board = STMSysBoard(platform, spi_lanes=args.spi_lanes, address_width=args.address_width,
+                                page_width=args.page_width, slots=slots, spi_cs=args.spi_cs, crc=args.crc,
+                                perf=args.perf)
+    write_csr_map(stm_sys_board.csr_map, "build")
 
     from migen.fhdl.specials import Tristate
     sim = False
-    so = {}
     if sim:
         so = {Tristate: LatticeECP5TrellisTristateDiamond}
-    platform.build(stm_sys_board, build_name="stm_sys_board", run=not sim, special_overrides=so)
+        platform.build(stm_sys_board, build_name="stm_sys_board", run=False, special_overrides=so)
+    else:
+        from build_report import build_report, write_report, print_report
+        cache_dir = None if args.no_cache else args.cache_dir
+        ran = cached_build(platform, stm_sys_board, cache_dir, build_name="stm_sys_board",
+                           seeds=list(range(1, args.seeds + 1)), jobs=args.jobs)
+        print("toolchain stages run: {}".format(", ".join(ran) or "none (all cached)"))
+        report = write_report(build_report("build", "stm_sys_board", cache_dir, slots, args.spi_cs),
+                              "build/stm_sys_board.report.json", args.baseline)
+        print_report(report)
+        if args.update_baseline:
+            write_report({k: v for k, v in report.items() if k != "changes"}, args.baseline)
@@ -0,0 +1,397 @@
+"""Simulation of the STM system board core with a cycle accurate SPI host model, runs with migen only.
+
+Without arguments runs a set of register accesses for a few SCK periods, each read checked, and prints
+transactions per second, latency per access type and errors as JSON. ``--check`` also runs the checks of
+``FEATURE_CHECKS`` (event FIFO, counters, input filter, CRC, paging, performance counters) and exits with
+status 1 on any error.
+"""
+import json
+from migen import *
+from stm_sys_board_hdl import STMSysBoard
+from stm_sys_board_driver import STMSysBoardDriver, crc8, frame_header, frame_timing
+
+
+class STMSysBoardSim(STMSysBoard):
+    """Slot controllers, registers and SPI bridge of ``STMSysBoard`` without I/O pins, clocked by the simulator."""
+    def __init__(self, spi_lanes=1, address_width=10, page_width=0, slots=8, read_dummy=12, crc=False, perf=False):
+        self.clock_domains.cd_sys = ClockDomain("sys")
+        self.clock_domains.cd_sck1 = ClockDomain("sck1", reset_less=True)
+        self.add_core(None, spi_lanes, address_width, page_width, slots, read_dummy, crc=crc, perf=perf)
+
+
+class SPIHost:
+    """SPI master model driving ``bridge`` (SPI2WB). Its generators run in the sck1 domain,
+    one simulator cycle is one SCK clock. Data is sampled one clock after it was driven,
+    like a master sampling on the opposite edge.
+
+    ``stats`` counts frames, words and SCK clocks (CS high time included) per access type.
+    With ``crc`` the header and words carry their CRC-8, read words with a bad CRC are counted in ``crc_errors``.
+    ``bad_crc`` of ``frame`` lists the words sent with an inverted CRC (0: header, n: data word n - 1).
+    """
+    def __init__(self, bridge, lanes=1, read_dummy=12, shadow_dummy=2, data_width=16, cs_clocks=2, crc=False):
+        self.bridge = bridge
+        self.lanes = lanes
+        self.read_dummy = read_dummy
+        self.shadow_dummy = shadow_dummy
+        self.data_width = data_width
+        self.cs_clocks = cs_clocks
+        self.crc = crc
+        self.crc_errors = 0
+        self.stats = {}
+
+    def _chunks(self, value, width):
+        bits = [value >> (width - 1 - i) & 1 for i in range(width)]
+        chunks = []
+        for i in range(0, width, self.lanes):
+            chunk = 0
+            for bit in bits[i:i + self.lanes]:
+                chunk = chunk << 1 | bit
+            chunks.append(chunk)
+        return chunks
+
+    def _word(self, value, width, bad_crc=False):
+        # Value followed by its CRC
+        if self.crc:
+            return value << 8 | crc8(value, width) ^ (0xff if bad_crc else 0), width + 8
+        return value, width
+
+    def frame(self, header, words=None, count=0, bad_crc=()):
+        """One frame, returns the words read."""
+        read = header >> 15 & 1
+        shadow = header >> 13 & 1
+        words = words or []
+        n = count if read else len(words)
+        data_start, stride, word_clocks = frame_timing(header, self.lanes, self.read_dummy, self.shadow_dummy,
+                                                       self.data_width, self.crc)
+
+        chunks = self._chunks(*self._word(header, 16, 0 in bad_crc))
+        chunks += [0] * (data_start - len(chunks))
+        if read:
+            chunks += [0] * ((n - 1) * stride + word_clocks if n else 0)
+        else:
+            for i, word in enumerate(words):
+                chunks += self._chunks(*self._word(word, self.data_width, i + 1 in bad_crc))
+
+        bridge = self.bridge
+        yield bridge.sel.eq(0)
+        for i in range(self.cs_clocks):
+            yield
+        yield bridge.sel.eq(1)
+        rx = []
+        for chunk in chunks:
+            yield bridge.sdi.eq(chunk)
+            yield
+            rx.append((yield bridge.sdo))
+        yield bridge.sel.eq(0)
+        yield
+        rx.append((yield bridge.sdo))
+        rx = rx[1:]
+
+        data = []
+        if read:
+            for i in range(n):
+                word = 0
+                for chunk in rx[data_start + i * stride:data_start + i * stride + word_clocks]:
+                    word = word << self.lanes | chunk
+                if self.crc:
+                    if crc8(word >> 8, self.data_width) != word & 0xff:
+                        self.crc_errors += 1
+                    word >>= 8
+                data.append(word)
+
+        kind = ("shadow " if shadow else "") + ("read" if read else "write") + (" burst" if n > 1 else "")
+        stats = self.stats.setdefault(kind, {"frames": 0, "words": 0, "clocks": 0})
+        stats["frames"] += 1
+        stats["words"] += n
+        stats["clocks"] += len(chunks) + self.cs_clocks + 1
+        return data
+
+    def run_driver(self, driver):
+        """Send the accesses queued in ``driver`` (STMSysBoardDriver)."""
+        for frame in driver.take_frames():
+            frame.complete((yield from self.frame(frame.header, frame.words, frame.count)))
+
+    def report(self, sck_period):
+        """Transactions per second and latency (ns) per access type, ``sck_period`` in ns."""
+        report = {}
+        for kind, stats in self.stats.items():
+            time = stats["clocks"] * sck_period
+            report[kind] = {
+                "frames": stats["frames"],
+                "transactions_per_s": stats["frames"] / time * 1e9,
+                "words_per_s": stats["words"] / time * 1e9,
+                "latency_ns": time / stats["frames"]
+            }
+        return report
+
+
+def run(dut, program, sck_period, sys_period=10, sck_phase=0, vcd_name=None, **generators):
+    """Run generator ``program`` in the sck1 domain of ``dut``, clock periods and SCK phase in ns.
+
+    ``generators`` are added per clock domain. The simulator works in whole time steps (ps here).
+    """
+    generators["sck1"] = [program] + generators.get("sck1", [])
+    clocks = {"sys": round(sys_period * 1000), "sck1": (round(sck_period * 1000), round(sck_phase * 1000))}
+    run_simulation(dut, generators, clocks=clocks, vcd_name=vcd_name)
+
+
+def wait_sys(dut, cycles):
+    """Wait at least ``cycles`` sys cycles from the sck1 domain, timed by the board timestamp."""
+    start = yield dut.timestamp
+    while (yield dut.timestamp) - start < cycles:
+        yield
+
+
+def send(host, driver, errors, kind, frames):
+    """Send the accesses queued in ``driver``, which must take ``frames`` frames (``kind`` names them in errors)."""
+    taken = driver.take_frames()
+    if len(taken) != frames:
+        errors.append("{}: {} frames instead of {}".format(kind, len(taken), frames))
+    for frame in taken:
+        frame.complete((yield from host.frame(frame.header, frame.words, frame.count)))
+
+
+def check(host, driver, errors, kind, frames, expected):
+    """``send`` the reads queued in ``driver``, then add an error for every (name, result, value) in ``expected``
+    whose read result is not the value."""
+    yield from send(host, driver, errors, kind, frames)
+    errors += ["{} {} {:#x}, expected {:#x}".format(name, kind, r.value, value)
+               for name, r, value in expected if r.value != value]
+
+
+def access_mix(dut, host, driver, errors, burst=8):
+    """Single, burst, gap filling and fixed address writes and reads and shadow reads, every access checked,
+    as a generator for ``run``."""
+    # Single writes and reads, one frame each
+    names = ["logic0_output", "logic0_oe", "logic0_interrupt_mask"]
+    for i, name in enumerate(names):
+        driver.write(name, 0x1234 + i)
+        yield from send(host, driver, errors, "single write", 1)
+    for i, name in enumerate(names):
+        yield from check(host, driver, errors, "single read", 1, [(name, driver.read(name), 0x1234 + i)])
+
+    # Burst write and read of consecutive registers
+    block = ["logic0_filter_mask", "logic0_interrupt_rising", "logic0_interrupt_falling"]
+    for i, name in enumerate(block):
+        driver.write(name, 0x5a00 + i)
+    yield from send(host, driver, errors, "burst write", 1)
+    yield from check(host, driver, errors, "burst read", 1,
+                     [(name, driver.read(name), 0x5a00 + i) for i, name in enumerate(block)])
+    # Output and output enable read in one frame with the input register between them
+    yield from check(host, driver, errors, "gap read", 1, [("logic0_output", driver.read("logic0_output"), 0x1234),
+                                                           ("logic0_oe", driver.read("logic0_oe"), 0x1235)])
+    for name, value in zip(block, [0, 0xffff, 0xffff]):
+        driver.write(name, value)
+    yield from send(host, driver, errors, "burst write", 1)
+
+    # Fixed address burst write of the sequencer words, checked on the outputs while the sequencer plays them
+    driver.write("logic0_seq_write_adr", 0)
+    yield from send(host, driver, errors, "single write", 1)
+    for i in range(burst):
+        driver.write("logic0_seq_data", 0x100 + i)
+    yield from send(host, driver, errors, "fixed address write", 1)
+    period = 20
+    driver.write("logic0_seq_length", burst)
+    driver.write("logic0_seq_period", period)
+    driver.write("logic0_seq_repeat", 1)
+    driver.write("logic0_seq_mask", 0xffff)
+    driver.write("logic0_seq_start", 1)
+    yield from send(host, driver, errors, "sequencer setup", 2)
+    # Outputs in the mask read 0 until the first word is played
+    played = []
+    for i in range(2 * burst * period):
+        value = 0
+        for j, t in enumerate(dut.logic0.slot):
+            value |= (yield t.o) << j
+        if value and (not played or played[-1] != value):
+            played.append(value)
+        yield
+    if played != [0x100 + i for i in range(burst)]:
+        errors.append("sequencer played {}".format([hex(v) for v in played]))
+    driver.write("logic0_seq_mask", 0)
+    yield from send(host, driver, errors, "single write", 1)
+
+    yield from check(host, driver, errors, "fixed address read", 1,
+                     [("id", driver.read("id"), 0xaaaa) for i in range(burst)])
+    # Shadow reads after one full sweep of the registers, each a three cycle Wishbone to CSR read
+    yield from wait_sys(dut, 3 * len(dut.csrs.simple_csrs) + 4)
+    yield from check(host, driver, errors, "shadow read", 1,
+                     [("id", driver.read("id", shadow=True), 0xaaaa) for i in range(burst)])
+
+
+def benchmark(sck_periods=(7.5, 10, 20, 50), spi_lanes=1, slots=1, crc=False):
+    report = {}
+    for sck_period in sck_periods:
+        dut = STMSysBoardSim(spi_lanes=spi_lanes, slots=slots, crc=crc)
+        host = SPIHost(dut.spi_slave, lanes=spi_lanes, crc=crc)
+        driver = STMSysBoardDriver(None, dut.csr_map)
+        errors = []
+        run(dut, access_mix(dut, host, driver, errors), sck_period)
+        if host.crc_errors:
+            errors.append("{} read words with CRC errors".format(host.crc_errors))
+        report[str(sck_period)] = {"access": host.report(sck_period), "errors": errors}
+    return report
+
+
+def toggle(dut, pin, high_cycles, low_cycles=None):
+    """Drive ``pin`` of slot 0 high for ``high_cycles`` and low for ``low_cycles`` (default the same) sys cycles."""
+    t = dut.logic0.slot[pin]
+    yield t.i.eq(1)
+    yield from wait_sys(dut, high_cycles)
+    yield t.i.eq(0)
+    yield from wait_sys(dut, high_cycles if low_cycles is None else low_cycles)
+
+
+def check_events(dut, host, driver, errors):
+    """A rising and a falling edge of pin 3 are read from the event FIFO as three words each, then 0."""
+    driver.write("logic0_interrupt_mask", 1 << 3)
+    driver.write("logic0_event_enable", 1)
+    yield from send(host, driver, errors, "config", 2)
+    yield from wait_sys(dut, 10)
+    rise = yield dut.timestamp
+    yield from toggle(dut, 3, 50)
+    yield from check(host, driver, errors, "read", 1,
+                     [("logic0_event_level", driver.read("logic0_event_level"), 2)])
+    words = [driver.read("logic0_event") for i in range(7)]
+    yield from send(host, driver, errors, "fixed address read", 1)
+    words = [r.value for r in words]
+    stamps = [words[i] | words[i + 1] << 16 | (words[i + 2] & 0x7ff) << 32 for i in (0, 3)]
+    if [words[2] >> 11, words[5] >> 11, words[6]] != [3 << 1 | 1, 3 << 1, 0]:
+        errors.append("event words {}".format([hex(w) for w in words]))
+    if not 0 < stamps[0] - rise < 10 or not 50 <= stamps[1] - stamps[0] < 60:
+        errors.append("event timestamps {} {} after the rising edge at {}".format(*stamps, rise))
+    yield from check(host, driver, errors, "read", 1,
+                     [("logic0_event_level", driver.read("logic0_event_level"), 0)])
+
+
+def check_counters(dut, host, driver, errors, pulses=5):
+    """Rising edges of pin 3 are counted, reading the low word then the high word."""
+    driver.write("logic0_counter_rising", 1 << 3)
+    driver.write("logic0_counter_falling", 0)
+    yield from send(host, driver, errors, "config", 1)
+    driver.write("logic0_counter_select", 3)
+    yield from send(host, driver, errors, "config", 1)
+    for i in range(pulses):
+        yield from toggle(dut, 3, 10)
+    yield from check(host, driver, errors, "read", 1,
+                     [("logic0_counter_low", driver.read("logic0_counter_low"), pulses),
+                      ("logic0_counter_high", driver.read("logic0_counter_high"), 0)])
+
+
+def check_filter(dut, host, driver, errors):
+    """With the filter on pin 3 a glitch shorter than the filter length is not counted, a longer pulse is."""
+    driver.write("logic0_counter_rising", 1 << 3)
+    yield from send(host, driver, errors, "config", 1)
+    driver.write("logic0_counter_select", 3)
+    driver.write("logic0_filter_length", 20)
+    driver.write("logic0_filter_mask", 1 << 3)
+    yield from send(host, driver, errors, "config", 2)
+    yield from wait_sys(dut, 20)
+    yield from toggle(dut, 3, 8, 40)
+    yield from check(host, driver, errors, "read after a glitch", 1,
+                     [("logic0_counter_low", driver.read("logic0_counter_low"), 0)])
+    yield from toggle(dut, 3, 40)
+    yield from check(host, driver, errors, "read after a pulse", 1,
+                     [("logic0_counter_low", driver.read("logic0_counter_low"), 1)])
+
+
+def check_crc(dut, host, driver, errors):
+    """A bad header CRC and a bad write word CRC are rejected and counted, read words of a bad header
+    come with a bad CRC."""
+    output = driver.registers["logic0_output"]["address"]
+    driver.write("logic0_output", 0x1111)
+    yield from send(host, driver, errors, "write", 1)
+    yield from host.frame(frame_header(False, False, False, output, driver.address_width), [0x2222], bad_crc=[0])
+    yield from host.frame(frame_header(False, False, False, output, driver.address_width), [0x3333], bad_crc=[1])
+    yield from host.frame(frame_header(True, False, False, output, driver.address_width), count=1, bad_crc=[0])
+    if host.crc_errors != 1:
+        errors.append("{} read words with a bad CRC, expected 1".format(host.crc_errors))
+    host.crc_errors = 0
+    yield from check(host, driver, errors, "read", 2, [("logic0_output", driver.read("logic0_output"), 0x1111),
+                                                       ("crc_errors", driver.read("crc_errors"), 3)])
+    # Reading subtracts the returned count
+    yield from check(host, driver, errors, "read", 1, [("crc_errors", driver.read("crc_errors"), 0)])
+
+
+def check_paging(dut, host, driver, errors):
+    """Registers of page 0 and 1, with page register writes by the driver in between."""
+    # Page 0 and 1 each written after their page register
+    driver.write("logic0_output", 0x4321)
+    driver.write("logic0_interrupt_falling", 0x1234)
+    yield from send(host, driver, errors, "write", 4)
+    # id still on page 1, id2 read along with interrupt_falling and id
+    yield from check(host, driver, errors, "read", 5, [
+        ("id", driver.read("id"), 0xaaaa),
+        ("logic0_output", driver.read("logic0_output"), 0x4321),
+        ("logic0_interrupt_falling", driver.read("logic0_interrupt_falling"), 0x1234),
+        ("id2", driver.read("id2"), 0x5555)
+    ])
+
+
+def check_perf(dut, host, driver, errors, accesses=3):
+    """Frames, reads and writes between two latches of the performance counters."""
+    driver.write("perf_latch", 1)
+    yield from send(host, driver, errors, "latch", 1)
+    for i in range(accesses):
+        driver.write("logic0_output", i)
+        yield from send(host, driver, errors, "write", 1)
+        driver.read("logic0_output")
+        yield from send(host, driver, errors, "read", 1)
+    driver.write("perf_latch", 0)
+    yield from send(host, driver, errors, "latch", 1)
+    # The restarting latch write is counted, the one latching is not
+    cycles = driver.read("perf_cycles")
+    yield from check(host, driver, errors, "read", 1, [
+        ("perf_frames", driver.read("perf_frames"), 2 * accesses + 1),
+        ("perf_reads", driver.read("perf_reads"), accesses),
+        ("perf_writes", driver.read("perf_writes"), accesses + 1),
+        ("perf_late_reads", driver.read("perf_late_reads"), 0),
+        ("perf_spi_busy0", driver.read("perf_spi_busy0"), 0)
+    ])
+    if not cycles.value:
+        errors.append("perf_cycles read 0")
+
+
+# Feature checks and the board they run on
+FEATURE_CHECKS = [
+    (check_events, {}),
+    (check_counters, {}),
+    (check_filter, {}),
+    (check_crc, {"crc": True}),
+    (check_paging, {"address_width": 6, "page_width": 2}),
+    (check_perf, {"perf": True})
+]
+
+
+def feature_checks(sck_period=10):
+    """Errors of every check of ``FEATURE_CHECKS``, by check name."""
+    report = {}
+    for program, options in FEATURE_CHECKS:
+        dut = STMSysBoardSim(slots=1, **options)
+        host = SPIHost(dut.spi_slave, crc=options.get("crc", False))
+        driver = STMSysBoardDriver(None, dut.csr_map)
+        errors = []
+        run(dut, program(dut, host, driver, errors), sck_period)
+        report[program.__name__] = errors
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Simulate SPI accesses to the STM system board core")
+    parser.add_argument("--sck-period", type=float, action="append",
+                        help="SCK period in ns, can be repeated (default: 7.5, 10, 20, 50)")
+    parser.add_argument("--spi-lanes", type=int, choices=[1, 2, 4], default=1)
+    parser.add_argument("--slots", type=int, default=1, help="slot controllers to simulate (board: 8)")
+    parser.add_argument("--crc", action="store_true", help="CRC-8 on the SPI frames")
+    parser.add_argument("--check", action="store_true",
+                        help="also run the feature checks, exit with status 1 on any error")
+    args = parser.parse_args()
+    sck_periods = args.sck_period or (7.5, 10, 20, 50)
+    report = benchmark(sck_periods, args.spi_lanes, args.slots, args.crc)
+    if args.check:
+        report["features"] = feature_checks()
+    print(json.dumps(report, indent=2))
+    if args.check and (any(report[str(p)]["errors"] for p in sck_periods) or any(report["features"].values())):
+        sys.exit(1)
@@ -1,21 +1,20 @@
 `timescale 1ns / 100ps
+// Register addresses generated by stm_sys_board_hdl.py (build/csr_map.vh)
+`include "csr_map.vh"
 
 module tb_stm_system_board();
 
 parameter SYS_PERIOD = 10;
 parameter SPI_PERIOD = 10;
 //dummy cycles is dependent on sys_period and spi_period
-parameter DUMMY_CYCLES = 10;
-parameter addr_w = 7;
+parameter DUMMY_CYCLES = 12;
+parameter addr_w = 10;
 parameter data_w = 16;
 parameter spi_model_data_width = 16;
-//number of slots in the design
-parameter slots_num = 2;
 
 reg [30*8-1:0] textsignal;
 integer i;
-//registers before spi_register
-integer offset_to_spi=slots_num*6;
+//the slot tasks access the registers of logic0, the slot controller of connector 1 (slot1 pins)
 
 reg                rst;
 reg              spi_clk;
@@ -77,6 +76,14 @@ task automatic spi_transaction (input read, input [addr_w-1:0] addr, input [data
 		spi_clk = 1'b1;
 		#(SPI_PERIOD/2);
 		spi_clk = 1'b0;
+		// fixed address (single word, no burst) and padding to 16 bit header
+		spi_mosi = 1'b0;
+		for (i = 0; i < 16-addr_w-1; i = i + 1) begin
+			#(SPI_PERIOD/2);
+			spi_clk = 1'b1;
+			#(SPI_PERIOD/2);
+			spi_clk = 1'b0;
+		end
 		// address
 		for (i = 0; i <= addr_w-1; i = i + 1) begin
 			spi_mosi = addr[addr_w-i-1];
@@ -85,8 +92,8 @@ task automatic spi_transaction (input read, input [addr_w-1:0] addr, input [data
 			#(SPI_PERIOD/2);
 			spi_clk = 1'b0;
 		end
-		// dummy cycles
-		for (i = 0; i < DUMMY_CYCLES; i = i + 1) begin
+		// dummy cycles (reads only)
+		for (i = 0; i < DUMMY_CYCLES*read; i = i + 1) begin
 			#(SPI_PERIOD/2);
 			spi_clk = 1'b1;
 			#(SPI_PERIOD/2);
@@ -128,92 +135,91 @@ task automatic spi_write_and_check(input [addr_w-1:0] addr, input [data_w-1:0] d
 	end
 endtask
 
-task automatic set_output(input [2:0] slot, input [data_w-1:0] data);
+task automatic set_output(input [data_w-1:0] data);
 	begin
-		spi_write(slot+slots_num*0, data);
+		spi_write(`CSR_LOGIC0_OUTPUT, data);
 	end
 endtask
-task automatic check_output(input [2:0] slot, input [data_w-1:0] data);
+task automatic check_output(input [data_w-1:0] data);
 	begin
-		#20 set_output(slot, data);
+		#20 set_output(data);
 		#50 if(slot1 != data) $error("Output not correct! Expected 0x%0h, seen: 0x%0h.", data, slot1);
 	end
 endtask
 
-task automatic read_input(input [2:0] slot, output [data_w-1:0] data_read);
+task automatic read_input(output [data_w-1:0] data_read);
 	begin
-		spi_read(slot+slots_num*1, 16'h0000, data_read);
+		spi_read(`CSR_LOGIC0_INPUT, 16'h0000, data_read);
 	end
 endtask
-task automatic check_input(input [2:0] slot, input [data_w-1:0] data);
+task automatic check_input(input [data_w-1:0] data);
 	begin
 		slot1_reg = data;
-  		read_input(slot, data_read);
+  		read_input(data_read);
   		#50 if(data_read != slot1_reg) $error("Output not correct! Expected 0x%0h, seen: 0x%0h.", slot1_reg, data_read);
 	end
 endtask
 
-task automatic set_direction(input [2:0] slot, input direction);
+task automatic set_direction(input direction);
 	begin
-		spi_write(slot+slots_num*2, 16'hffff*direction);
+		spi_write(`CSR_LOGIC0_OE, 16'hffff*direction);
 	end
 endtask
 
-task automatic read_interrupt(input [2:0] slot, output [data_w-1:0] data_read);
+task automatic read_interrupt(output [data_w-1:0] data_read);
 	begin
-		spi_read(slot+slots_num*3, 16'h0000, data_read);
+		spi_read(`CSR_LOGIC0_INTERRUPT, 16'h0000, data_read);
 	end
 endtask
 
-task automatic set_int_mask(input [2:0] slot, input [data_w-1:0] data);
+task automatic set_int_mask(input [data_w-1:0] data);
 	begin
-		spi_write(slot+slots_num*4, data);
+		spi_write(`CSR_LOGIC0_INTERRUPT_MASK, data);
 	end
 endtask
 
-task automatic clear_int(input [2:0] slot, input [data_w-1:0] data);
+task automatic clear_int(input [data_w-1:0] data);
 	begin
-		spi_write(slot+slots_num*5, data);
+		spi_write(`CSR_LOGIC0_INTERRUPT_CLEAR, data);
 	end
 endtask
 
 
-task automatic configure_spi_machine(input [2:0] slot);
+task automatic configure_spi_machine;
 	begin
-		offset_to_spi = (slot+1)*6;
 		//length = 16 bit -1
-		spi_write(offset_to_spi+1, spi_model_data_width-1);
+		spi_write(`CSR_LOGIC0_SPI_LENGTH, spi_model_data_width-1);
 		//active chip selects
-		spi_write(offset_to_spi+2, 1'b1);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_CS, 1'b1);
 		//cs_polarity
-		spi_write(offset_to_spi+3, 1'b0);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_CS_POLARITY, 1'b0);
 		//clk dif
-		spi_write(offset_to_spi+4, 8'h4);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_DIV, 8'h4);
 		//offline
-		spi_write(offset_to_spi+5, 1'b0);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_OFFLINE, 1'b0);
 		//clk polarity
-		spi_write(offset_to_spi+6, 1'b0);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_CLK_POLARITY, 1'b0);
 		//clk phase
-		//spi_write(offset_to_spi+7, 1'b0);
+		//spi_write(`CSR_LOGIC0_SPI_MASTER_CLK_PHASE, 1'b0);
 		//lsb_first
-		spi_write(offset_to_spi+8, 1'b0);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_LSB_FIRST, 1'b0);
 		//half duplex
-		spi_write(offset_to_spi+9, 1'b0);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_HALF_DUPLEX, 1'b0);
 		//end
-		spi_write(offset_to_spi+10, 1'b1);
+		spi_write(`CSR_LOGIC0_SPI_MASTER_END, 1'b1);
 	end
 endtask
 
 task automatic spi_machine_write_and_read(input [spi_model_data_width-1:0] data);
 	begin
-  		spi_write(offset_to_spi+0, data);
+  		spi_write(`CSR_LOGIC0_SPI_DATA, data);
 		  data_read = 0;
 		  while (data_read != 1) begin
 			//check idle
-		  	spi_read(offset_to_spi+13, 16'h00, data_read);
+		  	spi_read(`CSR_LOGIC0_SPI_MASTER_IDLE, 16'h00, data_read);
 		  end
 		  //if(spi_model != data) $error("SPI master write error");
-		  spi_read(offset_to_spi+0, data, data_read);
+		  spi_read(`CSR_LOGIC0_SPI_DATA, data, data_read);
 		  if(data_read != data_old) $error("SPI readback error");
 		  data_old = data;
 	end
@@ -248,7 +254,7 @@ initial begin
   textsignal = "SPI slave interface";
   spi_write_and_check(8'h00, 16'haaaa);
 
-  //#100 spi_write(offset_to_spi+0, 16'haaaa );
+  //#100 spi_write(`CSR_LOGIC0_SPI_DATA, 16'haaaa );
 
   spi_write_and_check(6'h00, 16'h5555);
   spi_write_and_check(6'h00, 16'h0000);
@@ -261,63 +267,63 @@ initial begin
   //textsignal = "Output";
   //#20 slot1_reg = 8'haa;
   //#20 slot1_dir = 1;
-  //set_direction(3'd0, 1); //output
+  //set_direction(1); //output
 
-  //check_output(3'd0, 16'h5555);
-  //check_output(3'd0, 16'haaaa);
-  //check_output(3'd0, 16'hffff);
-  //check_output(3'd0, 16'h0001);
-  //check_output(3'd0, 16'h0000);
-  //check_output(3'd0, 16'h8000);
+  //check_output(16'h5555);
+  //check_output(16'haaaa);
+  //check_output(16'hffff);
+  //check_output(16'h0001);
+  //check_output(16'h0000);
+  //check_output(16'h8000);
 
   //input check
   //textsignal = "Input";
   //#20 slot1_reg = 8'haa;
-  //set_direction(3'd0, 0); //input
+  //set_direction(0); //input
   //#20 slot1_dir = 0;
-  //check_input(3'd0, 16'h5555);
-  //check_input(3'd0, 16'haaaa);
-  //check_input(3'd0, 16'hffff);
-  //check_input(3'd0, 16'h0001);
-  //check_input(3'd0, 16'h0000);
-  //check_input(3'd0, 16'h8000);
+  //check_input(16'h5555);
+  //check_input(16'haaaa);
+  //check_input(16'hffff);
+  //check_input(16'h0001);
+  //check_input(16'h0000);
+  //check_input(16'h8000);
 
   //interrupt check
   //textsignal = "Interrupt";
   //slot1_reg = 8'h00;
-  //clear_int(3'd0, 16'hffff);
-  //set_int_mask(3'd0, 16'hffff);
-  //read_interrupt(3'd0, data_read);
+  //clear_int(16'hffff);
+  //set_int_mask(16'hffff);
+  //read_interrupt(data_read);
   //if(data_read != 16'h00) $error("Interrupts not cleared!");
   //slot1_reg = 8'h01;
-  //read_interrupt(3'd0, data_read);
+  //read_interrupt(data_read);
   //if(data_read != 16'h01) $error("Interrupt not registered!");
   //if(~interrupt) $error("Interrupt to STM is low!");
-  //clear_int(3'd0, 16'hffff);
-  //read_interrupt(3'd0, data_read);
+  //clear_int(16'hffff);
+  //read_interrupt(data_read);
   //if(data_read != 16'h00) $error("Interrupts not cleared!");
 
   //#20 slot1_reg = 8'h01;
-  //clear_int(3'd0, 16'hffff);
+  //clear_int(16'hffff);
 
   //SPI master interface check
   //textsignal = "SPI master interface";
   #20 slot1_dir = 1;
-  #20 configure_spi_machine(0);
+  #20 configure_spi_machine;
   #100
   //read idle
-  spi_read(offset_to_spi+13, 16'h00, data_read);
+  spi_read(`CSR_LOGIC0_SPI_MASTER_IDLE, 16'h00, data_read);
   if(data_read != 16'h01) $error("SPI idle = 0");
   //read writable
-  spi_read(offset_to_spi+12, 16'h00, data_read);
+  spi_read(`CSR_LOGIC0_SPI_MASTER_WRITABLE, 16'h00, data_read);
   if(data_read != 16'h01) $error("SPI writable = 0");
 
   data = 16'haa55;
-  spi_write(offset_to_spi+0, data);
+  spi_write(`CSR_LOGIC0_SPI_DATA, data);
   data_read = 0;
   while (data_read != 1) begin
 	//check idle
-  	spi_read(offset_to_spi+13, 16'h00, data_read);
+  	spi_read(`CSR_LOGIC0_SPI_MASTER_IDLE, 16'h00, data_read);
   end
   //if(spi_model != data) $error("SPI master write error");
   data_old = data;
@@ -330,11 +336,11 @@ initial begin
   //spi_machine_write_and_read(16'h0000);
   //spi_machine_write_and_read(16'h0000);
   #200
-  spi_write(offset_to_spi+0, 16'haaaa );
+  spi_write(`CSR_LOGIC0_SPI_DATA, 16'haaaa );
 
-  #3000 spi_write(offset_to_spi+0, 16'h55aa);
+  #3000 spi_write(`CSR_LOGIC0_SPI_DATA, 16'h55aa);
 
-  #20 spi_write(offset_to_spi+0, 16'haaaa);
+  #20 spi_write(`CSR_LOGIC0_SPI_DATA, 16'haaaa);
 
   
   #40000 if(error==0)